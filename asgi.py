@@ -0,0 +1,422 @@
+"""Асинхронный режим работы под ASGI-сервером.
+
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Зависимости режима (Starlette, uvicorn, a2wsgi, greenlet, aiosqlite, python-multipart) перечислены
+в requirements-asgi.txt; для PostgreSQL к ним добавляется asyncpg.
+
+Маршруты чтения постов, ленты и комментариев, запись постов, комментариев и лайков, загрузка
+изображений и поток событий обслуживаются Starlette с асинхронной сессией SQLAlchemy
+(aiosqlite для SQLite, asyncpg для PostgreSQL): пока запрос ждет базу, цикл событий
+обслуживает остальные. Выборки те же, что у Flask-маршрутов в main.py, и выполняются через
+AsyncSession.run_sync. Хэширование и проверка загрузки идут в пуле потоков, декодирование и
+ресайз Pillow - как и раньше, в пуле процессов ImageJobs. Поток событий - корутина на
+AsyncSubscription и не занимает поток, поэтому процесс держит тысячи открытых соединений.
+
+Остальные маршруты обслуживает то же Flask-приложение через a2wsgi в пуле из
+ASGI_WSGI_WORKERS потоков. Для нескольких процессов см. gunicorn.conf.py.
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Match, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import main
+from database import create_async_engine_from_env
+from events import AsyncSubscription
+from serialization import choose_encoding, compress_body, make_compressor
+
+# Потоки для маршрутов, которые остаются синхронными (Flask)
+ASGI_WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', 10))
+
+wsgi_app = main.create_app()
+
+# Движок создается при старте рабочего процесса (lifespan), поэтому его соединения не переходят через fork.
+# Объекты остаются доступны после commit: ленивой загрузки вне run_sync быть не должно
+async_session = async_sessionmaker(expire_on_commit=False)
+
+routes = []
+
+
+def route(path, methods=('GET',)):
+    """Регистрирует асинхронный маршрут и пишет его время ответа в метрики приложения."""
+    def decorator(endpoint):
+        @wraps(endpoint)
+        async def timed(request):
+            started = time.perf_counter()
+            response = await endpoint(request)
+            main.metrics.request_duration.observe(time.perf_counter() - started, route=path,
+                                                  method=request.method, status=response.status_code)
+            return response
+
+        routes.append(Route(path, timed, methods=list(methods)))
+        return endpoint
+    return decorator
+
+
+def response_encoding(request):
+    return choose_encoding(parse_accept_header(request.headers.get('accept-encoding')))
+
+
+def json_response(request, payload, status=200, headers=None):
+    """JSON тем же провайдером, что у Flask, со сжатием по тем же правилам, что register_compression."""
+    body = wsgi_app.json.dumps(payload).encode('utf-8')
+    headers = dict(headers or {}, Vary='Accept-Encoding')
+    encoding = response_encoding(request)
+    if encoding and len(body) >= main.COMPRESS_MIN_SIZE:
+        body = compress_body(body, encoding, main.COMPRESS_LEVEL, main.BROTLI_QUALITY)
+        headers['Content-Encoding'] = encoding
+    return Response(body, status_code=status, media_type='application/json', headers=headers)
+
+
+def page_response(request, items, next_cursor):
+    return json_response(request, items, headers={'X-Next-Cursor': next_cursor} if next_cursor else None)
+
+
+def wants_ndjson(request):
+    return main.wants_ndjson(request.query_params,
+                             parse_accept_header(request.headers.get('accept'), MIMEAccept))
+
+
+async def compress_chunks(chunks, encoding):
+    compress, finish = make_compressor(encoding, main.COMPRESS_LEVEL, main.BROTLI_QUALITY)
+    async for chunk in chunks:
+        data = compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield finish()
+
+
+def ndjson_response(request, build_query, serialize, error_message):
+    """Потоковый NDJSON, как main.stream_ndjson. build_query(session) строит запрос по синхронной сессии,
+    строки читаются из базы частями по NDJSON_YIELD_PER."""
+    async def generate():
+        async with async_session() as session:
+            try:
+                statement = build_query(session.sync_session).statement.execution_options(
+                    yield_per=main.NDJSON_YIELD_PER)
+                chunk, size = [], 0
+                async for row in await session.stream_scalars(statement):
+                    line = wsgi_app.json.dumps(serialize(row)) + '\n'
+                    chunk.append(line)
+                    size += len(line)
+                    if size >= main.NDJSON_CHUNK_SIZE:
+                        yield ''.join(chunk)
+                        chunk, size = [], 0
+                if chunk:
+                    yield ''.join(chunk)
+            except Exception as e:
+                print(f"Ошибка при потоковой выдаче ({error_message}): {e}")
+
+    chunks = generate()
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = response_encoding(request)
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+        headers['Content-Encoding'] = encoding
+    return StreamingResponse(chunks, media_type='application/x-ndjson', headers=headers)
+
+
+async def read_json(request):
+    """Тело запроса как dict или None, если это не объект JSON."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@route('/api/friends/{user_id:int}/posts')
+async def get_friends_posts_route(request):
+    user_id = request.path_params['user_id']
+    try:
+        limit, before = main.parse_page_args(args=request.query_params)
+    except ValueError:
+        return json_response(request, {'message': 'Invalid limit or cursor'}, 400)
+
+    if wants_ndjson(request):
+        return ndjson_response(request, lambda session: main.query_friends_posts(session, user_id, before),
+                               main.serialize_post, 'посты друзей')
+
+    def load_page(session):
+        posts = main.query_friends_posts(session, user_id, before, limit + 1).all()
+        posts, next_cursor = main.paginate(posts, limit, lambda post: (post.timestamp, post.post_id))
+        return [main.serialize_post(post) for post in posts], next_cursor
+
+    async with async_session() as session:
+        try:
+            return page_response(request, *await session.run_sync(load_page))
+        except Exception as e:
+            print(f"Ошибка при получении постов друзей: {e}")
+            return json_response(request, {'message': 'Failed to get friends posts'}, 500)
+
+
+@route('/api/friends/{user_id:int}/feed')
+async def get_friends_feed_route(request):
+    user_id = request.path_params['user_id']
+    try:
+        limit, before = main.parse_page_args(args=request.query_params)
+    except ValueError:
+        return json_response(request, {'message': 'Invalid limit or cursor'}, 400)
+
+    async with async_session() as session:
+        try:
+            return page_response(request, *await session.run_sync(main.load_feed_page, user_id, before, limit))
+        except Exception as e:
+            print(f"Ошибка при получении ленты друзей: {e}")
+            return json_response(request, {'message': 'Failed to get friends feed'}, 500)
+
+
+@route('/api/friends/{user_id:int}/today')
+async def get_friends_today_posts_route(request):
+    user_id = request.path_params['user_id']
+    async with async_session() as session:
+        try:
+            post_list = await session.run_sync(lambda sync_session: [
+                main.serialize_post_with_author(post) for post in main.query_friends_today_posts(sync_session, user_id)])
+            return json_response(request, post_list)
+        except Exception as e:
+            print(f"Ошибка при получении сегодняшних постов друзей: {e}")
+            return json_response(request, {'message': 'Failed to get friends posts for today'}, 500)
+
+
+@route('/api/posts/{post_id:int}/comments')
+async def get_post_comments_route(request):
+    post_id = request.path_params['post_id']
+    try:
+        limit, after = main.parse_page_args(cursor_arg='after', args=request.query_params)
+    except ValueError:
+        return json_response(request, {'message': 'Invalid limit or cursor'}, 400)
+
+    if wants_ndjson(request):
+        return ndjson_response(request, lambda session: main.query_post_comments(session, post_id, after),
+                               main.serialize_comment, 'комментарии')
+
+    def load_page(session):
+        comments = main.query_post_comments(session, post_id, after, limit + 1).all()
+        comments, next_cursor = main.paginate(comments, limit, lambda comment: (comment.timestamp, comment.comment_id))
+        return [main.serialize_comment(comment) for comment in comments], next_cursor
+
+    async with async_session() as session:
+        try:
+            return page_response(request, *await session.run_sync(load_page))
+        except Exception as e:
+            print(f"Ошибка при получении комментариев: {e}")
+            return json_response(request, {'message': 'Failed to get comments'}, 500)
+
+
+@route('/api/posts/{post_id:int}/likes/count')
+async def get_post_likes_count_route(request):
+    post_id = request.path_params['post_id']
+    async with async_session() as session:
+        try:
+            likes_count = await session.run_sync(main.load_likes_count, post_id)
+            return json_response(request, {'likes_count': likes_count})
+        except Exception as e:
+            print(f"Ошибка при получении лайков поста: {e}")
+            return json_response(request, {'message': 'Failed to get post likes'}, 500)
+
+
+@route('/api/posts/{post_id:int}/comments/count')
+async def get_post_comments_count_route(request):
+    post_id = request.path_params['post_id']
+    async with async_session() as session:
+        try:
+            comments_count = await session.run_sync(lambda sync_session: sync_session.query(
+                main.Post.comment_count).filter(main.Post.post_id == post_id).scalar() or 0)
+            return json_response(request, {'comments_count': comments_count})
+        except Exception as e:
+            print(f"Ошибка при получении количества комментариев: {e}")
+            return json_response(request, {'message': 'Failed to get post comments count'}, 500)
+
+
+@route('/api/posts', methods=['POST'])
+async def create_post_route(request):
+    data = await read_json(request)
+    if not data or not data.get('user_id') or not data.get('image_url'):
+        return json_response(request, {'message': 'Missing required fields'}, 400)
+
+    async with async_session() as session:
+        try:
+            new_post = await session.run_sync(main.create_post, data['user_id'], data['image_url'],
+                                              data.get('caption'))
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            print(f"Ошибка при создании поста: {e}")
+            return json_response(request, {'message': 'Failed to create post'}, 500)
+    main.publish_post(new_post)
+    return json_response(request, {'post_id': new_post.post_id, 'message': 'Post created successfully'}, 201)
+
+
+@route('/api/comments', methods=['POST'])
+async def add_comment_route(request):
+    data = await read_json(request)
+    if not data or not data.get('post_id') or not data.get('user_id') or not data.get('text'):
+        return json_response(request, {'message': 'Missing required fields'}, 400)
+
+    async with async_session() as session:
+        try:
+            new_comment = await session.run_sync(main.create_comment, data['post_id'], data['user_id'], data['text'])
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            print(f"Ошибка при добавлении комментария: {e}")
+            return json_response(request, {'message': 'Failed to add comment'}, 500)
+    main.publish_comment(new_comment)
+    return json_response(request, {'comment_id': new_comment.comment_id,
+                                   'message': 'Comment added successfully'}, 201)
+
+
+async def set_like(post_id, user_id, liked):
+    """main.set_like в асинхронной сессии. Буфер лайков читает базу синхронно, поэтому он вызывается в пуле потоков."""
+    if main.like_buffer:
+        return await run_in_threadpool(main.set_like, None, post_id, user_id, liked)
+    async with async_session() as session:
+        changed = await session.run_sync(main.set_like, post_id, user_id, liked)
+        await session.commit()
+        return changed
+
+
+@route('/api/likes', methods=['POST'])
+async def like_post_route(request):
+    data = await read_json(request)
+    if not data or not data.get('post_id') or not data.get('user_id'):
+        return json_response(request, {'message': 'Missing required fields'}, 400)
+
+    try:
+        post_id, user_id = main.parse_ids(data['post_id'], data['user_id'])
+    except ValueError:
+        return json_response(request, {'message': 'Invalid post_id or user_id'}, 400)
+    try:
+        changed = await set_like(post_id, user_id, True)
+    except Exception as e:
+        print(f"Ошибка при лайке поста: {e}")
+        return json_response(request, {'message': 'Failed to like post'}, 500)
+    if changed:
+        main.publish_like(post_id, user_id, True)
+    return json_response(request, {'message': 'Post liked successfully'})
+
+
+@route('/api/likes/{post_id:int}/{user_id:int}', methods=['DELETE'])
+async def unlike_post_route(request):
+    post_id, user_id = request.path_params['post_id'], request.path_params['user_id']
+    try:
+        changed = await set_like(post_id, user_id, False)
+    except Exception as e:
+        print(f"Ошибка при удалении лайка: {e}")
+        return json_response(request, {'message': 'Failed to remove like'}, 500)
+    if not changed:
+        return json_response(request, {'message': 'Like not found'}, 404)
+    main.publish_like(post_id, user_id, False)
+    return json_response(request, {'message': 'Like removed successfully'})
+
+
+def save_upload(filename, stream):
+    """main.save_upload в контексте Flask-приложения: хранилище изображений принадлежит ему."""
+    with wsgi_app.app_context():
+        return main.save_upload(filename, stream)
+
+
+@route('/api/upload/{user_id:int}', methods=['POST'])
+async def upload_image(request):
+    form = await request.form()
+    try:
+        image = form.get('image')
+        if image is None or isinstance(image, str):
+            return json_response(request, {'error': 'No image part'}, 400)
+        # Хэширование и проверка заголовка блокируют, поэтому идут в пуле потоков
+        payload, status = await run_in_threadpool(save_upload, image.filename or '', image.file)
+        return json_response(request, payload, status)
+    finally:
+        await form.close()
+
+
+@route('/api/stream/{user_id:int}')
+async def event_stream_route(request):
+    user_id = request.path_params['user_id']
+    if main.event_stream_unavailable:
+        return json_response(request, {'message': f'Event stream is unavailable: {main.event_stream_unavailable}'},
+                             503)
+    try:
+        post_ids, last_event_id = main.parse_stream_args(request.query_params, request.headers)
+    except ValueError:
+        return json_response(request, {'message': 'Invalid posts or Last-Event-ID'}, 400)
+    if len(post_ids) > main.SSE_MAX_POSTS:
+        return json_response(request, {'message': f'Too many posts (max {main.SSE_MAX_POSTS})'}, 400)
+    if main.event_broker.subscriber_count >= main.SSE_MAX_CLIENTS:
+        return json_response(request, {'message': 'Too many open streams, try again later'}, 503)
+
+    # Соединение с базой нужно только для списка друзей и возвращается в пул до начала потока
+    async with async_session() as session:
+        try:
+            topics = await session.run_sync(main.stream_topics, user_id, post_ids)
+        except Exception as e:
+            print(f"Ошибка при открытии потока событий: {e}")
+            return json_response(request, {'message': 'Failed to open stream'}, 500)
+
+    # Starlette читает тело потока и для HEAD, а этот поток бесконечен: отвечаем одними заголовками
+    if request.method == 'HEAD':
+        return Response(media_type='text/event-stream', headers=main.STREAM_HEADERS)
+
+    subscription = AsyncSubscription(topics, max_queue=main.SSE_QUEUE_SIZE)
+
+    async def generate():
+        # Подписываемся при первом чтении потока: для HEAD генератор не запускается и finally не выполнился бы
+        main.event_broker.subscribe(subscription, topics)
+        try:
+            chunks, last_sent = main.stream_preamble(subscription, last_event_id)
+            for chunk in chunks:
+                yield chunk
+            while True:
+                items = await subscription.get(main.SSE_HEARTBEAT)
+                chunks, last_sent = main.render_stream_items(subscription, items, last_sent)
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            main.event_broker.unsubscribe(subscription, subscription.topics)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=main.STREAM_HEADERS)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    async_engine = create_async_engine_from_env(wsgi_app.config['DATABASE_URL'])
+    async_session.configure(bind=async_engine)
+    yield
+    await async_engine.dispose()
+
+
+async_app = Starlette(routes=routes, lifespan=lifespan, middleware=[
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+               expose_headers=['X-Next-Cursor'])])
+flask_app = WSGIMiddleware(wsgi_app, workers=ASGI_WSGI_WORKERS)
+
+
+async def application(scope, receive, send):
+    """Запросы к асинхронным маршрутам (и lifespan) - в async_app, остальное - во Flask.
+
+    Маршрут, совпавший только по пути (например, OPTIONS), тоже уходит во Flask: там его обработает flask_cors.
+    """
+    if scope['type'] != 'http' or any(candidate.matches(scope)[0] == Match.FULL for candidate in routes):
+        await async_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(application, host='0.0.0.0', port=5000)
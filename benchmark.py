@@ -0,0 +1,262 @@
+"""Бенчмарк основных эндпоинтов на синтетических наборах данных разного размера.
+
+Для каждого размера набор данных генерируется bulk_generation.py (и переиспользуется между
+запусками), после чего в отдельном процессе приложение нагружается запросами внутри процесса
+(Flask test client) и через локальный HTTP-сервер. По каждому эндпоинту считаются
+пропускная способность, p50/p95/p99 и число SQL-запросов на запрос.
+
+Результат сравнивается с сохраненной базовой линией: если p95 вырос больше допуска или
+запросов к базе стало больше, бенчмарк завершается с кодом 1.
+
+    python benchmark.py --sizes 1000,10000,100000 --requests 200
+    python benchmark.py --sizes 1000,10000 --save-baseline
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.client
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+ENDPOINTS = ['friends_posts', 'friends_feed', 'friends', 'search', 'upload_image', 'get_image']
+QUERIES = ['ana', 'kol', 'mar', 'ne', 'vi', 'sa', 'lee', 'tan']
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def random_image(rng):
+    """Небольшая JPEG-картинка со случайным содержимым (каждая уникальна, дедупликация не срабатывает)."""
+    from PIL import Image
+    img = Image.frombytes('RGB', (64, 48), rng.randbytes(64 * 48 * 3)).resize((1600, 1200))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+def build_requests(rng, user_ids, token, image_urls):
+    """Фабрики запросов: имя эндпоинта -> функция, возвращающая (метод, путь, заголовки, тело формы)."""
+    auth = {'Authorization': f'Bearer {token}'}
+    return {
+        'friends_posts': lambda: ('GET', f'/api/friends/{rng.choice(user_ids)}/posts', {}, None),
+        'friends_feed': lambda: ('GET', f'/api/friends/{rng.choice(user_ids)}/feed', {}, None),
+        'friends': lambda: ('GET', f'/api/friends/{rng.choice(user_ids)}', auth, None),
+        'search': lambda: ('GET', f'/api/users/search?query={rng.choice(QUERIES)}', auth, None),
+        'upload_image': lambda: ('POST', f'/api/upload/{rng.choice(user_ids)}', {}, random_image(rng)),
+        'get_image': lambda: ('GET', f'/images/{rng.choice(image_urls)}?size=thumb', {}, None),
+    }
+
+
+def run_in_process(app, make_request, count):
+    client = app.test_client()
+    latencies = []
+    for _ in range(count):
+        method, path, headers, image = make_request()
+        data = {'image': (io.BytesIO(image), 'bench.jpg')} if image else None
+        started = time.perf_counter()
+        response = client.open(path, method=method, headers=headers, data=data)
+        latencies.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            raise RuntimeError(f'{method} {path}: {response.status_code}')
+    return latencies
+
+
+def encode_multipart(image):
+    boundary = 'benchmark-boundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="bench.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n').encode() + image + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def run_over_http(port, make_request, count, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [count]
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        break
+                    remaining[0] -= 1
+                    method, path, headers, image = make_request()
+                body = None
+                if image:
+                    body, content_type = encode_multipart(image)
+                    headers = dict(headers, **{'Content-Type': content_type})
+                started = time.perf_counter()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                elapsed = time.perf_counter() - started
+                if response.status >= 500:
+                    raise RuntimeError(f'{method} {path}: {response.status}')
+                with lock:
+                    latencies.append(elapsed)
+        except Exception as e:
+            # Исключение в потоке теряется; сохраняем его и останавливаем остальные потоки
+            with lock:
+                errors.append(e)
+                remaining[0] = 0
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return latencies
+
+
+def run_worker(args):
+    """Выполняется в отдельном процессе: поднимает приложение на базе нужного размера и печатает JSON."""
+    os.environ['DATABASE_URL'] = f'sqlite:///{args.database}'
+    os.environ['IMAGE_STORAGE_PATH'] = args.image_dir
+    # Обработка в потоке запроса, чтобы время загрузки включало декодирование и кодирование
+    os.environ.setdefault('IMAGE_WORKERS', '0')
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    import bulk_generation
+    import database
+    import main
+
+    app = main.create_app()
+    if not args.reuse:
+        bulk_generation.generate(database.engine, bulk_generation.GenerationConfig(users=args.size, seed=args.seed))
+
+    rng = random.Random(args.seed)
+    session = main.Session()
+    user_ids = [user_id for user_id, in session.query(main.User.user_id).limit(10000)]
+    main.Session.remove()
+    client = app.test_client()
+    token = client.post('/api/login', json={'email': f'user{user_ids[0]}@example.com',
+                                            'password': bulk_generation.PASSWORD}).get_json()['token']
+    image_urls = [client.post(f'/api/upload/{user_ids[0]}', data={'image': (io.BytesIO(random_image(rng)), 'a.jpg')})
+                  .get_json()['image_url'] for _ in range(5)]
+    factories = build_requests(rng, user_ids, token, image_urls)
+
+    queries = [0]
+    event.listen(database.engine, 'before_cursor_execute', lambda *a, **kw: queries.__setitem__(0, queries[0] + 1))
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    for mode in args.modes:
+        for endpoint in ENDPOINTS:
+            count = max(1, args.requests // 10) if endpoint == 'upload_image' else args.requests
+            queries[0] = 0
+            started = time.perf_counter()
+            if mode == 'inprocess':
+                latencies = run_in_process(app, factories[endpoint], count)
+            else:
+                latencies = run_over_http(server.server_port, factories[endpoint], count, args.concurrency)
+            elapsed = time.perf_counter() - started
+            results[f'{mode}/{endpoint}'] = {
+                'requests': count,
+                'throughput': count / elapsed,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'queries_per_request': queries[0] / count,
+            }
+    server.shutdown()
+    print(json.dumps(results))
+
+
+def compare(results, baseline, tolerance):
+    """Список регрессий относительно базовой линии."""
+    regressions = []
+    for size, endpoints in results.items():
+        for name, current in endpoints.items():
+            previous = baseline.get(size, {}).get(name)
+            if not previous:
+                continue
+            if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{size} {name}: p95 {previous['p95_ms']:.1f} -> {current['p95_ms']:.1f} мс")
+            if current['queries_per_request'] > previous['queries_per_request'] + 0.01:
+                regressions.append(f"{size} {name}: SQL-запросов на запрос "
+                                   f"{previous['queries_per_request']:.1f} -> {current['queries_per_request']:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк эндпоинтов Glimpse.')
+    parser.add_argument('--sizes', default='1000,10000', help='Размеры наборов данных (число пользователей).')
+    parser.add_argument('--requests', type=int, default=200, help='Запросов на эндпоинт.')
+    parser.add_argument('--modes', default='inprocess,http')
+    parser.add_argument('--concurrency', type=int, default=4, help='Параллельных клиентов в режиме http.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'glimpse-benchmark'),
+                        help='Каталог для сгенерированных баз (переиспользуются между запусками).')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимый рост p95 (доля).')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    parser.add_argument('--image-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--reuse', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.modes = args.modes.split(',')
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {}
+    for size in (int(size) for size in args.sizes.split(',')):
+        database = os.path.join(args.data_dir, f'users_{size}_seed_{args.seed}.db')
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--size', str(size),
+                   '--database', database, '--image-dir', os.path.join(args.data_dir, 'images'),
+                   '--requests', str(args.requests), '--modes', ','.join(args.modes),
+                   '--concurrency', str(args.concurrency), '--seed', str(args.seed)]
+        if os.path.exists(database):
+            command.append('--reuse')
+        try:
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        except subprocess.CalledProcessError as e:
+            print(f"Ошибка замера на {size} пользователях:\n{e.stderr}", file=sys.stderr)
+            raise
+        results[str(size)] = json.loads(output.strip().splitlines()[-1])
+
+        print(f'\n{size} пользователей')
+        print(f"{'эндпоинт':<28}{'rps':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'SQL/запр':>10}")
+        for name, stats in results[str(size)].items():
+            print(f"{name:<28}{stats['throughput']:>8.0f}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}"
+                  f"{stats['p99_ms']:>9.1f}{stats['queries_per_request']:>10.1f}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nБазовая линия сохранена в {args.baseline}')
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\nРЕГРЕССИИ ПРОИЗВОДИТЕЛЬНОСТИ:')
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('\nРегрессий относительно базовой линии нет')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Генератор больших синтетических наборов данных для нагрузочного тестирования.
+
+В отличие от generation.py, строки пишутся пачками (executemany) в больших транзакциях,
+поэтому миллионы строк загружаются за минуты, а не за часы. Граф дружбы строится
+предпочтительным присоединением (Барабаши-Альберт) и имеет степенное распределение
+степеней; активность пользователей, лайки и комментарии тоже распределены по Парето.
+При одинаковом seed результат одинаков.
+
+У всех сгенерированных пользователей пароль "password", почта user<id>@example.com.
+
+Запуск из командной строки:
+    python bulk_generation.py --database-url sqlite:///load.db --users 100000 --days 30
+
+Из кода (схема в базе уже должна существовать):
+    generate(engine, GenerationConfig(users=1000, seed=1))
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import random
+import time
+from dataclasses import dataclass, asdict
+
+from sqlalchemy import MetaData, func, select
+
+PASSWORD = 'password'
+SYLLABLES = ['an', 'na', 'ma', 'ri', 'ko', 'le', 'ni', 'sa', 'da', 'vi', 'ol', 'ga', 'ev', 'ta', 'mi', 'ra', 'lu',
+             'ka', 'to', 'el', 'ya', 'zo', 'be', 'ne']
+COMMENTS = ['Крутая фотка!', 'Согласен!', 'Класс', 'Где это?', 'Отличный день!', 'Вау', '🔥', 'Скучаю!']
+CAPTIONS = [None, 'Мой день', 'Утро', 'Вечер', 'Наслаждаюсь жизнью!', 'В отпуске!', 'Работаю', 'Гуляю']
+
+
+@dataclass
+class GenerationConfig:
+    users: int = 1000
+    avg_friends: int = 20  # средняя степень в графе дружбы
+    mutual_ratio: float = 0.8  # доля дружб, подтвержденных в обе стороны
+    days: int = 30  # за сколько последних дней генерировать посты
+    post_probability: float = 0.3  # вероятность поста в день у пользователя средней активности
+    likes_per_post: float = 5.0
+    comments_per_post: float = 1.0
+    seed: int = 42
+    batch_size: int = 10000  # строк в одном executemany
+    commit_every: int = 200000  # строк в одной транзакции
+
+
+def pareto(rng, mean, alpha=1.5):
+    """Случайная величина с распределением Парето и заданным средним."""
+    return (rng.paretovariate(alpha) - 1) * mean * (alpha - 1)
+
+
+class BatchWriter:
+    """Копит строки по таблицам и пишет их пачками executemany, фиксируя транзакцию каждые commit_every строк.
+
+    tables задает порядок записи: перед пачкой таблицы сбрасываются буферы всех предыдущих,
+    чтобы строки с внешними ключами не опережали родительские.
+    """
+
+    def __init__(self, connection, tables, batch_size, commit_every):
+        self.connection = connection
+        self.tables = tables
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.buffers = {table: [] for table in tables}
+        self.counts = {table.name: 0 for table in tables}
+        self._uncommitted = 0
+        self._transaction = connection.begin()
+
+    def add(self, table, row):
+        buffer = self.buffers[table]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        for parent in self.tables[:self.tables.index(table)]:
+            self._write(parent)
+        self._write(table)
+
+    def _write(self, table):
+        rows = self.buffers[table]
+        if not rows:
+            return
+        self.connection.execute(table.insert(), rows)
+        self.counts[table.name] += len(rows)
+        self._uncommitted += len(rows)
+        self.buffers[table] = []
+        if self._uncommitted >= self.commit_every:
+            self._transaction.commit()
+            self._transaction = self.connection.begin()
+            self._uncommitted = 0
+
+    def close(self):
+        self.flush(self.tables[-1])
+        self._transaction.commit()
+
+
+def build_friend_graph(rng, user_ids, avg_friends):
+    """Граф предпочтительного присоединения: каждый новый пользователь добавляет avg_friends/2 друзей,
+    выбирая популярных с большей вероятностью. Возвращает список ребер (кто добавил, кого добавил)."""
+    links = max(1, avg_friends // 2)
+    repeated = []
+    edges = []
+    for index, user_id in enumerate(user_ids):
+        if index == 0:
+            continue
+        count = min(index, links)
+        chosen = set()
+        while len(chosen) < count:
+            if repeated and rng.random() < 0.9:
+                candidate = rng.choice(repeated)
+            else:
+                candidate = user_ids[rng.randrange(index)]
+            if candidate != user_id:
+                chosen.add(candidate)
+        for friend_id in chosen:
+            edges.append((user_id, friend_id))
+        repeated.extend(chosen)
+        repeated.extend([user_id] * count)
+    return edges
+
+
+def generate(engine, config=None):
+    """Генерирует набор данных в базу engine. Возвращает число вставленных строк по таблицам."""
+    config = config or GenerationConfig()
+    rng = random.Random(config.seed)
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=['users', 'posts', 'friendships', 'comments', 'likes'])
+    users, posts, friendships, comments, likes = (metadata.tables[name] for name in
+                                                  ('users', 'posts', 'friendships', 'comments', 'likes'))
+    password_hash = hashlib.sha256(PASSWORD.encode('utf-8')).hexdigest()
+
+    with engine.connect() as connection:
+        # Новые строки дописываются после существующих, поэтому генератор можно запускать повторно
+        first_user_id = (connection.execute(select(func.max(users.c.user_id))).scalar() or 0) + 1
+        first_post_id = (connection.execute(select(func.max(posts.c.post_id))).scalar() or 0) + 1
+        first_comment_id = (connection.execute(select(func.max(comments.c.comment_id))).scalar() or 0) + 1
+        connection.rollback()
+
+        writer = BatchWriter(connection, [users, friendships, posts, comments, likes],
+                             config.batch_size, config.commit_every)
+        user_ids = list(range(first_user_id, first_user_id + config.users))
+        for user_id in user_ids:
+            username = (''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(user_id)).capitalize()
+            writer.add(users, {'user_id': user_id, 'username': username, 'username_folded': username.casefold(),
+                               'password': password_hash, 'email': f'user{user_id}@example.com',
+                               'profile_pic': None, 'status': ''})
+        writer.flush(users)
+
+        # followers[author] - кто видит посты автора (добавил его в друзья)
+        followers = {user_id: [] for user_id in user_ids}
+        for user_id, friend_id in build_friend_graph(rng, user_ids, config.avg_friends):
+            writer.add(friendships, {'user_id': user_id, 'friend_id': friend_id})
+            followers[friend_id].append(user_id)
+            if rng.random() < config.mutual_ratio:
+                writer.add(friendships, {'user_id': friend_id, 'friend_id': user_id})
+                followers[user_id].append(friend_id)
+        writer.flush(friendships)
+
+        now = datetime.datetime.utcnow()
+        today = datetime.datetime.combine(now.date(), datetime.time.min)
+        post_id, comment_id = first_post_id, first_comment_id
+        for user_id in user_ids:
+            activity = min(1.0, config.post_probability * pareto(rng, 1.0, alpha=2.5))
+            audience = followers[user_id]
+            for day in range(config.days):
+                if rng.random() >= activity:
+                    continue
+                timestamp = min(now, today - datetime.timedelta(days=day) +
+                                datetime.timedelta(seconds=rng.randrange(86400)))
+                likers = rng.sample(audience, min(len(audience), round(pareto(rng, config.likes_per_post))))
+                commenters = [rng.choice(audience) for _ in range(round(pareto(rng, config.comments_per_post)))] \
+                    if audience else []
+                writer.add(posts, {'post_id': post_id, 'user_id': user_id,
+                                   'image_path': f'bulk/{user_id}/{post_id}.jpg', 'caption': rng.choice(CAPTIONS),
+                                   'timestamp': timestamp, 'like_count': len(likers),
+                                   'comment_count': len(commenters)})
+                for liker_id in likers:
+                    writer.add(likes, {'post_id': post_id, 'user_id': liker_id})
+                for commenter_id in commenters:
+                    writer.add(comments, {'comment_id': comment_id, 'post_id': post_id, 'user_id': commenter_id,
+                                          'text': rng.choice(COMMENTS),
+                                          'timestamp': timestamp + datetime.timedelta(
+                                              seconds=rng.randrange(3600))})
+                    comment_id += 1
+                post_id += 1
+        writer.close()
+    return writer.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Генерация синтетических данных для нагрузочного тестирования.')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'sqlite:///glimpse.db'))
+    defaults = GenerationConfig()
+    for name, value in asdict(defaults).items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    # Схему (таблицы, индексы, триггеры поиска) создает фабрика приложения
+    import database
+    import main as app_module
+    app_module.create_app({'DATABASE_URL': args.database_url})
+
+    config = GenerationConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    started = time.perf_counter()
+    counts = generate(database.engine, config)
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+    print(f'Вставлено {total} строк за {elapsed:.1f} с ({total / elapsed:.0f} строк/с)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Кэши в памяти процесса."""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по числу элементов, суммарному объему и времени жизни.
+
+    sizeof(value) задает "вес" элемента для max_bytes; ttl - время жизни в секундах.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, ttl=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, size, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (value, size, expires_at)
+            self._bytes += size
+            while (self.max_items is not None and len(self._items) > self.max_items) or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key):
+        """Удаляет элемент (явная инвалидация)."""
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._items.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'items': len(self._items),
+                'bytes': self._bytes,
+            }
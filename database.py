@@ -0,0 +1,161 @@
+"""Подключение к базе данных: движок, пул соединений и сессии запросов.
+
+Адрес базы берется из DATABASE_URL (по умолчанию локальный SQLite). Для SQLite включаются WAL,
+synchronous=NORMAL, busy_timeout, mmap и увеличенный кэш страниц, чтобы параллельные записи
+лайков и комментариев не упирались в "database is locked". Для серверных СУБД (PostgreSQL и т.п.)
+настраивается пул соединений.
+"""
+import os
+
+from flask import current_app, has_app_context
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import Session as OrmSession, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.schema import CreateColumn
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///glimpse.db')
+DB_ECHO = os.environ.get('DB_ECHO', '0') == '1'
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # мс
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))  # отрицательное значение - в КиБ
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настраивает каждое новое соединение SQLite."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+def create_engine_from_env(url=DATABASE_URL, echo=DB_ECHO):
+    """Создает движок для url с настройками пула и (для SQLite) PRAGMA."""
+    if url.startswith('sqlite'):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            # База в памяти существует, пока живо соединение, поэтому оно одно на все потоки
+            engine = create_engine(url, echo=echo, poolclass=StaticPool,
+                                   connect_args={'check_same_thread': False})
+        else:
+            engine = create_engine(url, echo=echo, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+                                   max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                                   connect_args={'check_same_thread': False,
+                                                 'timeout': SQLITE_BUSY_TIMEOUT / 1000})
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+
+    return create_engine(url, echo=echo, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                         pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+
+
+# Асинхронные драйверы для ASGI-режима
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def create_async_engine_from_env(url=DATABASE_URL, echo=DB_ECHO):
+    """Асинхронный движок для asgi.py: тот же адрес базы с асинхронным драйвером (aiosqlite, asyncpg)."""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    scheme, rest = url.split('://', 1)
+    url = f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+    if scheme.startswith('sqlite'):
+        if rest in ('', '/:memory:'):
+            # У асинхронного драйвера было бы свое соединение и, значит, своя пустая база
+            raise ValueError('ASGI mode needs a file or server database, not in-memory SQLite')
+        engine = create_async_engine(url, echo=echo, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                     pool_timeout=DB_POOL_TIMEOUT,
+                                     connect_args={'timeout': SQLITE_BUSY_TIMEOUT / 1000})
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+        return engine
+
+    return create_async_engine(url, echo=echo, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+
+
+def migrate_schema(metadata, bind):
+    """Приводит схему к моделям, не трогая данные: создает недостающие таблицы, колонки и индексы.
+
+    Возвращает добавленные к существующим таблицам колонки в виде 'таблица.колонка'.
+    """
+    metadata.create_all(bind)
+    inspector = inspect(bind)
+    preparer = bind.dialect.identifier_preparer
+    added = []
+    with bind.begin() as connection:
+        for table in metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    print(f"Не удалось добавить колонку {table.name}.{column.name}: нужен server_default")
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=bind.dialect)
+                connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}'))
+                added.append(f'{table.name}.{column.name}')
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+    return added
+
+
+# Движок создает init_engine() (из фабрики приложения), а не импорт модуля
+engine = None
+
+
+class AppBoundSession(OrmSession):
+    """Сессия, которая внутри контекста Flask-приложения работает с движком этого приложения
+    (app.extensions['database']), а вне его (фоновые потоки, скрипты) - с движком последнего init_engine()."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if has_app_context():
+            app_engine = current_app.extensions.get('database')
+            if app_engine is not None:
+                return app_engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+# Сессия привязана к потоку запроса; приложение вызывает Session.remove() по завершении запроса
+Session = scoped_session(sessionmaker(class_=AppBoundSession))
+
+
+def init_engine(url=DATABASE_URL, echo=DB_ECHO):
+    """Создает движок для url и делает его движком Session по умолчанию.
+
+    Движки, созданные раньше, не закрываются: ими могут пользоваться другие приложения процесса.
+    """
+    global engine
+    Session.remove()
+    engine = create_engine_from_env(url, echo)
+    Session.configure(bind=engine)
+    return engine
+
+
+def dispose_engine_after_fork():
+    """Забывает соединения, унаследованные от родительского процесса, не закрывая их.
+
+    Сокет (или файл SQLite) соединения после fork общий с родителем; закрытие в дочернем процессе
+    сломало бы его родителю, а использование из двух процессов - обоим. Новые соединения пул откроет сам.
+    """
+    if engine is not None:
+        engine.dispose(close=False)
+
+
+def register_session_teardown(app):
+    """Закрывает сессию запроса после каждого запроса, даже если обработчик упал."""
+    @app.teardown_appcontext
+    def remove_session(exception=None):
+        Session.remove()
@@ -0,0 +1,141 @@
+"""Публикация событий внутри процесса для потока Server-Sent Events.
+
+Маршруты записи публикуют событие в тему (posts:<автор>, post:<post_id>, user:<user_id>) после
+commit, брокер раздает его подписчикам этих тем. Подписчик - любой объект с методом
+deliver(item); Subscription копит события в ограниченной очереди для синхронного генератора
+SSE, а асинхронный сервер может подставить свою реализацию на asyncio.Queue.
+
+Ожидание события в Subscription.get() построено на threading.Condition. На обычном
+многопоточном сервере каждое открытое соединение занимает поток; чтобы держать тысячи
+простаивающих соединений, сервер запускается с гринлетами (gunicorn -k gevent), которые
+подменяют threading, и тогда соединение стоит один гринлет, а не поток. В ASGI-режиме
+(asgi.py) вместо нее используется AsyncSubscription: соединение - это корутина, ждущая
+asyncio.Event, и потоков не требует вовсе.
+"""
+import asyncio
+import threading
+from collections import deque
+
+
+class Subscription:
+    """Очередь событий одного клиента. При переполнении старые события выбрасываются, а клиент получает resync."""
+
+    def __init__(self, topics, max_queue=1000):
+        self.topics = set(topics)
+        self.max_queue = max_queue
+        self.overflowed = False
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def deliver(self, item):
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.overflowed = True
+            self._queue.append(item)
+            self._condition.notify()
+
+    def get(self, timeout):
+        """Ждет события до timeout секунд. Возвращает накопленные события (пустой список по таймауту)."""
+        with self._condition:
+            if not self._queue:
+                self._condition.wait(timeout)
+            items = list(self._queue)
+            self._queue.clear()
+            return items
+
+
+class AsyncSubscription:
+    """Очередь событий клиента асинхронного сервера. deliver() можно вызывать из любого потока:
+    событие передается в цикл событий через call_soon_threadsafe."""
+
+    def __init__(self, topics, max_queue=1000, loop=None):
+        self.topics = set(topics)
+        self.max_queue = max_queue
+        self.overflowed = False
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue = deque()
+        self._ready = asyncio.Event()
+
+    def deliver(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._append, item)
+        except RuntimeError:
+            # Цикл событий уже закрыт (остановка сервера)
+            pass
+
+    def _append(self, item):
+        if len(self._queue) >= self.max_queue:
+            self._queue.popleft()
+            self.overflowed = True
+        self._queue.append(item)
+        self._ready.set()
+
+    async def get(self, timeout):
+        """Ждет события до timeout секунд. Возвращает накопленные события (пустой список по таймауту)."""
+        if not self._queue:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        items = list(self._queue)
+        self._queue.clear()
+        self._ready.clear()
+        return items
+
+
+class EventBroker:
+    """Темы и их подписчики. Каждое событие получает возрастающий номер, последние хранятся для Last-Event-ID."""
+
+    def __init__(self, replay_size=1000):
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._subscribers = set()
+        self._sequence = 0
+        self._recent = deque(maxlen=replay_size)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self, subscriber, topics):
+        with self._lock:
+            self._subscribers.add(subscriber)
+            for topic in topics:
+                self._topics.setdefault(topic, set()).add(subscriber)
+
+    def add_topics(self, subscriber, topics):
+        """Подписывает на новые темы (например, на посты только что добавленного друга)."""
+        self.subscribe(subscriber, topics)
+
+    def unsubscribe(self, subscriber, topics):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            for topic in topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._topics[topic]
+
+    def publish(self, topic, event):
+        """Раздает событие подписчикам темы. Доставка не блокирует публикующий запрос."""
+        with self._lock:
+            self._sequence += 1
+            item = (self._sequence, topic, event)
+            self._recent.append(item)
+            subscribers = list(self._topics.get(topic, ()))
+        for subscriber in subscribers:
+            subscriber.deliver(item)
+
+    def replay(self, after_sequence, topics):
+        """События после after_sequence по темам topics (для переподключения с Last-Event-ID).
+
+        Возвращает None, если нужные события уже вытеснены или номер из другого запуска процесса.
+        """
+        with self._lock:
+            if after_sequence > self._sequence:
+                return None
+            if self._recent and self._recent[0][0] > after_sequence + 1:
+                return None
+            return [item for item in self._recent if item[0] > after_sequence and item[1] in topics]
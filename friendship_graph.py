@@ -0,0 +1,66 @@
+"""Индекс графа дружбы в памяти процесса.
+
+Хранит списки смежности в обе стороны, поэтому взаимные друзья находятся пересечением
+множеств за O(степень вершины) без обращения к базе. Индекс живет в одном процессе:
+при нескольких воркерах записи из соседних процессов в него не попадут.
+"""
+import threading
+
+
+class FriendshipGraph:
+    """Граф дружбы: кого добавил пользователь (following) и кто добавил его (followers)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._following = {}
+        self._followers = {}
+        self._pending = None
+        self.loaded = False
+
+    def ensure_loaded(self, fetch_pairs):
+        """Загружает граф один раз. fetch_pairs возвращает пары (user_id, friend_id) из базы."""
+        if self.loaded:
+            return
+        with self._load_lock:
+            if self.loaded:
+                return
+            # Ребра, добавленные во время чтения из базы, докатываем поверх снимка
+            with self._lock:
+                self._pending = []
+            pairs = fetch_pairs()
+            with self._lock:
+                following, followers = {}, {}
+                for user_id, friend_id in list(pairs) + self._pending:
+                    following.setdefault(user_id, set()).add(friend_id)
+                    followers.setdefault(friend_id, set()).add(user_id)
+                self._following, self._followers = following, followers
+                self._pending = None
+                self.loaded = True
+
+    def add(self, user_id, friend_id):
+        """Добавляет ребро user_id -> friend_id после успешной записи в базу."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, friend_id))
+            self._following.setdefault(user_id, set()).add(friend_id)
+            self._followers.setdefault(friend_id, set()).add(user_id)
+
+    def following(self, user_id):
+        """Пользователи, которых добавил user_id."""
+        with self._lock:
+            return set(self._following.get(user_id, ()))
+
+    def followers(self, user_id):
+        """Пользователи, которые добавили user_id."""
+        with self._lock:
+            return set(self._followers.get(user_id, ()))
+
+    def mutual(self, user_id):
+        """Взаимные друзья: пересечение following и followers."""
+        with self._lock:
+            following = self._following.get(user_id, set())
+            followers = self._followers.get(user_id, set())
+            if len(following) > len(followers):
+                following, followers = followers, following
+            return {friend_id for friend_id in following if friend_id in followers}
@@ -1,4 +1,4 @@
-from __main__ import User, Like, Comment, Post, Friendship
+from models import User, Like, Comment, Post, Friendship
 import hashlib
 
 
@@ -69,6 +69,8 @@ def add_comment(session, post_id, user_id, text):
     new_comment = Comment(post_id=post_id, user_id=user_id, text=text)
     session.add(new_comment)
     try:
+        session.query(Post).filter(Post.post_id == post_id).update(
+            {Post.comment_count: Post.comment_count + 1}, synchronize_session=False)
         session.commit()
         return new_comment
     except Exception as e:
@@ -82,6 +84,8 @@ def like_post(session, post_id, user_id):
     like = Like(post_id=post_id, user_id=user_id)
     session.add(like)
     try:
+        session.query(Post).filter(Post.post_id == post_id).update(
+            {Post.like_count: Post.like_count + 1}, synchronize_session=False)
         session.commit()
         return True
     except Exception as e:
@@ -108,7 +112,7 @@ def get_post_comments(session, post_id):
 
 def get_post_likes_count(session, post_id):
     """Получает количество лайков для определенного поста."""
-    return session.query(Like).filter(Like.post_id == post_id).count()
+    return session.query(Post.like_count).filter(Post.post_id == post_id).scalar() or 0
 
 
 def generation(session):
@@ -0,0 +1,68 @@
+"""Настройки gunicorn: несколько рабочих процессов (prefork), приложение загружается до fork.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+
+Для воркера UvicornWorker и asgi.py нужны зависимости из requirements-asgi.txt.
+
+С preload_app мастер один раз импортирует код и вызывает create_app(): схема базы обновляется
+один раз, а не наперегонки в каждом воркере. Воркеры получают загруженные модули, маппинги
+SQLAlchemy и шаблоны через fork и делят эти страницы памяти, пока их не изменят (copy-on-write).
+gc.freeze() убирает загруженные объекты из поколений сборщика мусора, чтобы сборки в воркерах
+не касались этих страниц.
+
+После fork каждый воркер вызывает main.after_fork(): пул соединений забывает соединения мастера,
+а фоновый поток буфера лайков и пул процессов обработки изображений создаются заново.
+
+Состояние в памяти у каждого воркера свое: кэши и метрики считаются по процессу, а
+FRIENDS_GRAPH_CACHE и LIKE_WRITE_BEHIND рассчитаны на один процесс.
+
+Поток событий (/api/stream) включается, только если его можно обслужить: брокер событий живет
+в памяти процесса, поэтому при нескольких воркерах поток не получал бы событий других воркеров,
+а воркер с потоком на запрос (sync, gthread) занимал бы поток на каждое открытое соединение.
+Поэтому SSE работает с одним воркером UvicornWorker (или gevent/eventlet для WSGI):
+
+    WEB_CONCURRENCY=1 gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+
+В остальных конфигурациях /api/stream отвечает 503, а клиенты опрашивают обычные маршруты.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+# По одному воркеру на ядро; у каждого GUNICORN_THREADS потоков (у UvicornWorker - цикл событий)
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+preload_app = True
+
+# Воркеры, в которых открытый поток событий не занимает поток ОС
+STREAMING_WORKERS = ('UvicornWorker', 'UvicornH11Worker', 'GeventWorker', 'GeventPyWSGIWorker', 'EventletWorker')
+
+
+def event_stream_unavailable(cfg):
+    """Причина, по которой SSE нельзя обслуживать в этой конфигурации, или None."""
+    if cfg.workers > 1:
+        return 'events are not shared between worker processes, run a single worker'
+    if cfg.worker_class.__name__ not in STREAMING_WORKERS:
+        return 'the worker holds a thread per open stream, run asgi:application with UvicornWorker'
+    return None
+
+
+def when_ready(server):
+    # Приложение уже создано в мастере: соединения, открытые при обновлении схемы, мастеру не нужны
+    import database
+    import main
+    database.engine.dispose()
+
+    # Воркеры наследуют решение через fork
+    main.event_stream_unavailable = event_stream_unavailable(server.cfg)
+    if main.event_stream_unavailable:
+        print(f"Поток событий отключен: {main.event_stream_unavailable}")
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import main
+    main.after_fork()
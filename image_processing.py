@@ -0,0 +1,256 @@
+"""Обработка загруженных изображений в отдельном пуле процессов.
+
+Запрос на загрузку только сохраняет исходный файл, проверяет его заголовок и ставит задачу
+в очередь, а декодирование, масштабирование, поворот и кодирование JPEG выполняются в процессах
+пула. Модуль не импортирует main.py, чтобы процессы пула не поднимали приложение и базу.
+
+Память на декодирование ограничена: размеры проверяются по заголовку до декодирования,
+JPEG декодируется сразу в уменьшенном масштабе (draft), а поворот по EXIF выполняется
+уже после уменьшения.
+
+Pillow импортируется внутри функций: он нужен только при загрузке и в процессах пула, а не при
+старте приложения.
+"""
+import multiprocessing
+import os
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Производные размеры по длинной стороне; full - максимальный размер Instagram-подобного формата
+IMAGE_SIZES = {'full': 1080, 'medium': 540, 'thumb': 150}
+MAX_SIZE = (IMAGE_SIZES['full'], IMAGE_SIZES['full'])
+ALLOWED_FORMATS = ('JPEG', 'PNG')
+DEFAULT_MAX_PIXELS = 50_000_000
+
+
+class ImageRejected(ValueError):
+    """Файл не является допустимым изображением или слишком велик для декодирования."""
+
+
+def inspect_image(path, max_pixels):
+    """Проверяет формат и размеры по заголовку, не декодируя пиксели. Возвращает (формат, (ширина, высота))."""
+    from PIL import Image, UnidentifiedImageError
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        try:
+            with Image.open(path, formats=ALLOWED_FORMATS) as img:
+                image_format, size = img.format, img.size
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+            raise ImageRejected('Image is too large')
+        except UnidentifiedImageError:
+            raise ImageRejected('Unsupported or corrupted image')
+    if size[0] * size[1] > max_pixels:
+        raise ImageRejected(f'Image is too large: {size[0]}x{size[1]}')
+    return image_format, size
+
+
+def derivative_path(file_path, size='full', webp=False):
+    """Путь к производному файлу: full хранится по исходному пути, остальные с суффиксом размера."""
+    stem, extension = os.path.splitext(file_path)
+    if size != 'full':
+        stem = f'{stem}_{size}'
+    return stem + ('.webp' if webp else extension)
+
+
+def resize_and_rotate_image(img):
+    """Уменьшает до MAX_SIZE и поворачивает по EXIF. Поворот после уменьшения - по маленькому изображению."""
+    from PIL import Image, ImageOps
+
+    # Определяем новые размеры, сохраняя пропорции; MAX_SIZE квадратный, поэтому поворот на них не влияет
+    img.thumbnail(MAX_SIZE, Image.Resampling.LANCZOS)
+
+    # Поворачиваем по ориентации из EXIF (у изображений без EXIF возвращается как есть)
+    return ImageOps.exif_transpose(img)
+
+
+def save_atomic(img, path, image_format, **params):
+    """Пишет во временный файл и переименовывает, чтобы клиенту не попал недописанный файл."""
+    tmp_path = path + '.tmp'
+    img.save(tmp_path, image_format, **params)
+    os.replace(tmp_path, path)
+
+
+def mark_failed(raw_path, file_path, error):
+    """Заменяет исходный файл маркером <file_path>.failed с текстом ошибки."""
+    with open(file_path + '.failed', 'w', encoding='utf-8') as f:
+        f.write(str(error))
+    try:
+        os.remove(raw_path)
+    except FileNotFoundError:
+        pass
+
+
+def process_upload(raw_path, file_path, webp=False, max_pixels=DEFAULT_MAX_PIXELS):
+    """Обрабатывает сохраненный исходный файл и пишет JPEG (и WebP) всех размеров. Выполняется в процессе пула.
+
+    Исходный файл удаляется и при ошибке: вместо него остается маркер <file_path>.failed, иначе
+    загрузка считалась бы ожидающей обработки вечно.
+    """
+    try:
+        result = convert_upload(raw_path, file_path, webp, max_pixels)
+    except Exception as e:
+        mark_failed(raw_path, file_path, e)
+        raise
+    os.remove(raw_path)
+    try:
+        os.remove(file_path + '.failed')
+    except FileNotFoundError:
+        pass
+    return result
+
+
+def convert_upload(raw_path, file_path, webp, max_pixels):
+    """Декодирует исходный файл и пишет производные. Возвращает сведения для метрик."""
+    from PIL import Image
+
+    started = time.perf_counter()
+    inspect_image(raw_path, max_pixels)
+    # Предел проверяем сами, не меняя Image.MAX_IMAGE_PIXELS: при IMAGE_WORKERS=0 это настройка всего сервера
+    try:
+        img = Image.open(raw_path, formats=ALLOWED_FORMATS)
+    except Image.DecompressionBombError:
+        raise ImageRejected('Image is too large')
+    with img:
+        source_size = img.size
+        if source_size[0] * source_size[1] > max_pixels:
+            raise ImageRejected(f'Image is too large: {source_size[0]}x{source_size[1]}')
+        # JPEG декодируем сразу в масштабе 1/2..1/8, но не меньше итогового размера
+        scale = min(1.0, MAX_SIZE[0] / img.width, MAX_SIZE[1] / img.height)
+        img.draft(None, (round(img.width * scale), round(img.height * scale)))
+        img.load()
+        # Оценка пикового буфера декодирования: размер после draft на число каналов
+        decode_memory = img.width * img.height * len(img.getbands())
+        decoded_size = img.size
+
+        # Палитру переводим в RGB до масштабирования, иначе ресэмплинг будет NEAREST
+        if img.mode in ('P', '1'):
+            img = img.convert('RGB')
+
+        processed_img = resize_and_rotate_image(img)
+
+        # JPEG не поддерживает прозрачность
+        if processed_img.mode not in ('RGB', 'L'):
+            processed_img = processed_img.convert('RGB')
+
+        # Меньшие размеры получаем последовательным уменьшением уже обработанного изображения.
+        # Основной файл пишем последним: его появление означает, что готовы все производные.
+        full_img = processed_img.copy()
+        for size in ('medium', 'thumb'):
+            processed_img.thumbnail((IMAGE_SIZES[size], IMAGE_SIZES[size]), Image.Resampling.LANCZOS)
+            save_atomic(processed_img, derivative_path(file_path, size), 'JPEG', quality=85, optimize=True)
+            if webp:
+                save_atomic(processed_img, derivative_path(file_path, size, webp=True), 'WEBP', quality=80)
+        if webp:
+            save_atomic(full_img, derivative_path(file_path, webp=True), 'WEBP', quality=80)
+        save_atomic(full_img, file_path, 'JPEG', quality=85, optimize=True)
+    return {'processing_time': time.perf_counter() - started, 'source_size': source_size,
+            'decoded_size': decoded_size, 'decode_memory': decode_memory}
+
+
+class ImageJobs:
+    """Очередь задач обработки изображений с ограниченным пулом процессов и статусами задач.
+
+    При max_workers=0 задачи выполняются синхронно в потоке запроса (удобно для отладки).
+    on_finish(job) вызывается с копией задачи после ее завершения (например, для метрик).
+    """
+
+    def __init__(self, max_workers, max_pending, webp=False, max_pixels=DEFAULT_MAX_PIXELS,
+                 history_size=1000, on_finish=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.webp = webp
+        self.max_pixels = max_pixels
+        self.history_size = history_size
+        self.on_finish = on_finish
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._pending_urls = {}
+
+    def reset_after_fork(self):
+        """В дочернем процессе после fork: пул процессов родителя здесь не работает, новый создается при
+        первой задаче. Задачи родителя остаются ему."""
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._pending_urls = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, а не fork: дочерний процесс не наследует сокеты клиентов и потоки сервера
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, job_id, raw_path, file_path, image_url):
+        """Ставит задачу в очередь. Возвращает job_id или None, если очередь заполнена."""
+        job = {'job_id': job_id, 'status': 'pending', 'image_url': image_url}
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+            self._jobs[job_id] = job
+            self._pending_urls[image_url] = job_id
+            self._trim_history()
+
+        paths = (raw_path, file_path)
+        if self.max_workers == 0:
+            try:
+                self._finish(job, paths, process_upload(raw_path, file_path, self.webp, self.max_pixels), None)
+            except Exception as e:
+                self._finish(job, paths, None, e)
+            return job_id
+
+        try:
+            future = self._get_executor().submit(process_upload, raw_path, file_path, self.webp, self.max_pixels)
+        except Exception as e:
+            self._finish(job, paths, None, e)
+            return job_id
+        future.add_done_callback(
+            lambda f: self._finish(job, paths, None if f.exception() else f.result(), f.exception()))
+        return job_id
+
+    def _finish(self, job, paths, result, error):
+        if error is not None:
+            # Процесс пула мог упасть, не дойдя до process_upload; исходный файл убираем и здесь
+            try:
+                mark_failed(*paths, error)
+            except OSError as e:
+                print(f"Ошибка при пометке неудачной загрузки: {e}")
+        with self._lock:
+            self._pending -= 1
+            self._pending_urls.pop(job['image_url'], None)
+            if error is None:
+                job.update(result)
+                job['status'] = 'done'
+            else:
+                job['status'] = 'failed'
+                job['error'] = str(error)
+            finished = dict(job)
+        if self.on_finish is not None:
+            self.on_finish(finished)
+
+    def _trim_history(self):
+        # Забываем самые старые завершенные задачи, незавершенные не трогаем
+        while len(self._jobs) > self.history_size:
+            oldest_id = next((job_id for job_id, job in self._jobs.items() if job['status'] != 'pending'), None)
+            if oldest_id is None:
+                break
+            del self._jobs[oldest_id]
+
+    def find(self, image_url):
+        """job_id незавершенной задачи для image_url в этом процессе или None."""
+        with self._lock:
+            return self._pending_urls.get(image_url)
+
+    def status(self, job_id):
+        """Статус задачи в этом процессе или None, если задача здесь неизвестна."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
@@ -0,0 +1,152 @@
+"""Хранилище изображений, адресуемое хэшем содержимого.
+
+Файл загрузки называется по SHA-256 его байтов: cas/ab/cd/<hash>.jpg. Одинаковые загрузки
+(повторные публикации, повторы после таймаута) попадают в один и тот же файл и повторно
+не обрабатываются. Обработка детерминирована, поэтому хэш исходных байтов однозначно задает
+и обработанный результат.
+"""
+import hashlib
+import os
+import re
+import time
+import uuid
+
+from image_processing import IMAGE_SIZES, derivative_path
+
+CHUNK_SIZE = 64 * 1024
+OBJECT_NAME = re.compile(r'^[0-9a-f]{64}\.jpg$')
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_older(path, seconds):
+    """True, если файл не менялся дольше seconds секунд (отсутствующий файл - False)."""
+    try:
+        return time.time() - os.path.getmtime(path) > seconds
+    except FileNotFoundError:
+        return False
+
+
+class ContentStore:
+    """Каталог cas/ внутри хранилища изображений."""
+
+    def __init__(self, root, prefix='cas'):
+        self.root = root
+        self.prefix = prefix
+        self.tmp_directory = os.path.join(root, prefix, 'tmp')
+
+    def relative_path(self, digest):
+        """Относительный путь объекта, который хранится в Post.image_path."""
+        return f'{self.prefix}/{digest[:2]}/{digest[2:4]}/{digest}.jpg'
+
+    def absolute_path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    def write_temp(self, stream):
+        """Сохраняет поток во временный файл, считая хэш по ходу записи. Возвращает (путь, хэш)."""
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_directory, uuid.uuid4().hex + '.upload')
+        digest = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        return tmp_path, digest.hexdigest()
+
+    def claim(self, tmp_path, file_path, stale_after=None):
+        """Переносит временный файл в <file_path>.upload.
+
+        Возвращает False, если такая же загрузка уже ждет обработки (в любом процессе). Ожидающий файл
+        старше stale_after секунд считается брошенным (процесс, ставивший задачу, завершился) и заменяется.
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        upload_path = file_path + '.upload'
+        try:
+            # link не перезаписывает существующий файл, поэтому работает как блокировка на содержимое
+            os.link(tmp_path, upload_path)
+            return True
+        except FileExistsError:
+            if stale_after is None or not is_older(upload_path, stale_after):
+                return False
+            os.replace(tmp_path, upload_path)
+            return True
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def sweep_uploads(self, max_age):
+        """Удаляет брошенные файлы ожидающих загрузок и временные файлы старше max_age секунд. Возвращает их число."""
+        removed = 0
+        for directory, subdirectories, filenames in os.walk(os.path.join(self.root, self.prefix)):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if (directory == self.tmp_directory or filename.endswith(('.upload', '.tmp'))) \
+                        and is_older(path, max_age):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    def upload_status(self, digest):
+        """Статус обработки объекта по файлам хранилища, одинаковый во всех процессах.
+
+        Возвращает словарь с полями status (done, pending или failed) и error либо None, если объекта нет.
+        """
+        file_path = self.absolute_path(self.relative_path(digest))
+        # Основной файл пишется последним, а маркер ошибки - до удаления исходного файла
+        if os.path.exists(file_path):
+            return {'status': 'done'}
+        if os.path.exists(file_path + '.upload'):
+            return {'status': 'pending'}
+        try:
+            with open(file_path + '.failed', encoding='utf-8') as f:
+                return {'status': 'failed', 'error': f.read()}
+        except FileNotFoundError:
+            return None
+
+    def touch(self, file_path):
+        """Отмечает объект как нужный для сборщика мусора. Возвращает False, если объекта нет.
+
+        Обновляется mtime файла <file_path>.live, а не самого объекта: от mtime объекта зависит
+        Last-Modified, а содержимое по этому адресу не меняется.
+        """
+        if not os.path.exists(file_path):
+            return False
+        with open(file_path + '.live', 'a'):
+            pass
+        os.utime(file_path + '.live')
+        return True
+
+    def iter_objects(self):
+        """Перебирает объекты хранилища: (относительный путь, время последнего использования)."""
+        for directory, subdirectories, filenames in os.walk(os.path.join(self.root, self.prefix)):
+            if directory == self.tmp_directory:
+                subdirectories[:] = []
+                continue
+            for filename in filenames:
+                if OBJECT_NAME.match(filename):
+                    path = os.path.join(directory, filename)
+                    relative_path = os.path.relpath(path, self.root).replace('\\', '/')
+                    mtime = os.path.getmtime(path)
+                    try:
+                        mtime = max(mtime, os.path.getmtime(path + '.live'))
+                    except FileNotFoundError:
+                        pass
+                    yield relative_path, mtime
+
+    def remove(self, relative_path):
+        """Удаляет объект вместе со всеми производными размерами."""
+        file_path = self.absolute_path(relative_path)
+        for size in IMAGE_SIZES:
+            for webp in (False, True):
+                try:
+                    os.remove(derivative_path(file_path, size, webp))
+                except FileNotFoundError:
+                    pass
+        try:
+            os.remove(file_path + '.live')
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,181 @@
+"""Отложенная запись лайков (write-behind).
+
+Лайк и его снятие не коммитятся сразу: состояние пары (post_id, user_id) копится в памяти,
+и в базу раз в flush_interval секунд (или при max_pending парах) одной транзакцией пишется
+только итоговая разница. Частые переключения лайка на популярном посте взаимно гасятся и не
+доходят до базы.
+
+Для каждой пары хранится [base, desired]: состояние в базе на момент первого изменения и
+последнее желаемое. Чтения дополняют данные из базы поправками из буфера (read), поэтому
+счетчики и отметка "лайкнул ли я" видны сразу. Буфер живет в одном процессе; при нескольких
+воркерах каждый видит только свои незаписанные лайки.
+"""
+import atexit
+import threading
+
+
+class LikeBuffer:
+    """Буфер лайков с фоновым сбросом.
+
+    fetch_liked(post_id, user_id) - есть ли лайк в базе; write_changes(session, to_add, to_remove) -
+    записывает изменения в текущую транзакцию сессии из session_factory (commit делает буфер).
+    """
+
+    def __init__(self, session_factory, fetch_liked, write_changes, flush_interval=1.0, max_pending=1000):
+        self.session_factory = session_factory
+        self.fetch_liked = fetch_liked
+        self.write_changes = write_changes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        # Пачка, которая сейчас пишется в базу; видна чтениям до commit
+        self._flushing = {}
+        # Чистое изменение числа лайков по постам для всего незакоммиченного
+        self._deltas = {}
+        # Число коммитов буфера: чтение из базы, пересекшееся с коммитом, повторяется
+        self._commits = 0
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def reset_after_fork(self):
+        """В дочернем процессе после fork: фонового потока родителя нет, а его незаписанные
+        изменения запишет сам родитель, поэтому буфер начинает пустым."""
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        self._flushing = {}
+        self._deltas = {}
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='like-buffer-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _known_state(self, key):
+        """Последнее известное состояние пары из буфера или None. Вызывается под self._lock."""
+        entry = self._pending.get(key) or self._flushing.get(key)
+        return entry[1] if entry else None
+
+    def set(self, post_id, user_id, liked):
+        """Ставит или снимает лайк. Возвращает предыдущее состояние (был ли лайк)."""
+        key = (post_id, user_id)
+        while True:
+            with self._lock:
+                commits = self._commits
+                known = self._known_state(key)
+            base = known if known is not None else self.fetch_liked(post_id, user_id)
+            with self._lock:
+                # Пока читали базу, пару мог изменить другой запрос или закоммитить сброс
+                if self._commits != commits or self._known_state(key) != known:
+                    continue
+                entry = self._pending.get(key)
+                if entry is None:
+                    entry = self._pending[key] = [base, base]
+                previous = entry[1]
+                if previous != liked:
+                    entry[1] = liked
+                    self._deltas[post_id] = self._deltas.get(post_id, 0) + (1 if liked else -1)
+                pending = len(self._pending)
+                break
+        self._start()
+        if pending >= self.max_pending:
+            self._wakeup.set()
+        return previous
+
+    def read(self, query, post_ids, user_id=None):
+        """Выполняет query() и возвращает (результат, {post_id: поправка к like_count},
+        {post_id: лайкнул ли user_id}) для постов post_ids(результат).
+
+        Если во время запроса буфер закоммитил пачку, запрос повторяется, чтобы ее изменения
+        не учлись дважды.
+        """
+        while True:
+            with self._lock:
+                commits = self._commits
+            result = query()
+            with self._lock:
+                if self._commits != commits:
+                    continue
+                ids = post_ids(result)
+                deltas = {post_id: self._deltas[post_id] for post_id in ids if self._deltas.get(post_id)}
+                liked = {}
+                if user_id is not None:
+                    for post_id in ids:
+                        state = self._known_state((post_id, user_id))
+                        if state is not None:
+                            liked[post_id] = state
+                return result, deltas, liked
+
+    def states(self, query, keys):
+        """Выполняет query() и возвращает (результат, {пара: состояние}) для пар из keys, которые есть в буфере.
+
+        Как и read, повторяет запрос, если во время него буфер закоммитил пачку.
+        """
+        while True:
+            with self._lock:
+                commits = self._commits
+            result = query()
+            with self._lock:
+                if self._commits != commits:
+                    continue
+                states = {}
+                for key in keys:
+                    state = self._known_state(key)
+                    if state is not None:
+                        states[key] = state
+                return result, states
+
+    def flush(self):
+        """Пишет накопленные изменения одной транзакцией."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+            to_add = [key for key, (base, desired) in batch.items() if desired and not base]
+            to_remove = [key for key, (base, desired) in batch.items() if base and not desired]
+
+            session = self.session_factory()
+            try:
+                self.write_changes(session, to_add, to_remove)
+                with self._lock:
+                    session.commit()
+                    self._commits += 1
+                    for post_id, user_id in to_add:
+                        self._deltas[post_id] -= 1
+                    for post_id, user_id in to_remove:
+                        self._deltas[post_id] += 1
+                    self._deltas = {post_id: delta for post_id, delta in self._deltas.items() if delta}
+                    self._flushing = {}
+            except Exception as e:
+                session.rollback()
+                print(f"Ошибка при записи лайков: {e}")
+                # Возвращаем пачку в буфер; более новые изменения тех же пар остаются поверх нее
+                with self._lock:
+                    for key, entry in batch.items():
+                        if key in self._pending:
+                            self._pending[key][0] = entry[0]
+                        else:
+                            self._pending[key] = entry
+                    self._flushing = {}
+            finally:
+                session.close()
+
+    def close(self):
+        """Останавливает фоновый сброс и пишет остаток буфера."""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
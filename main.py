@@ -1,122 +1,158 @@
+import time
+
+# Время старта считаем с начала импорта модуля, включая загрузку зависимостей
+STARTUP_BEGAN = time.perf_counter()
+
 import hashlib
+import hmac
+import io
 from functools import wraps
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime, UniqueConstraint, func
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.ext.declarative import declarative_base
-from flask import Flask, render_template, request, jsonify, send_file
+from collections import Counter, namedtuple
+from sqlalchemy import DateTime, func, and_, or_, select, insert, delete, tuple_, literal, exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload, contains_eager
+from flask import Blueprint, Flask, Response, current_app, render_template, request, jsonify, send_file
+import json
 from flask_cors import CORS
 import datetime
 from datetime import date
 import os
+import click
 import jwt
-import uuid
-from PIL import Image, ExifTags
-
-DATABASE_URL = "sqlite:///glimpse.db"
-
-engine = create_engine(DATABASE_URL, echo=True)
-
-app = Flask(__name__)
-CORS(app)
-
-Base = declarative_base()
+from cache import LRUCache
+from events import EventBroker, Subscription
+from database import DATABASE_URL, Session, init_engine, dispose_engine_after_fork, register_session_teardown, \
+    migrate_schema
+from friendship_graph import FriendshipGraph
+from image_processing import ImageJobs, ImageRejected, IMAGE_SIZES, derivative_path, inspect_image
+from image_store import DIGEST, ContentStore
+from like_buffer import LikeBuffer
+from metrics import Metrics
+from models import Base, User, Post, Friendship, Comment, Like, TimelineEntry
+from serialization import install_json_provider, register_compression
+from user_search import backfill_folded_usernames, install_username_search, search_users as search_usernames
+
+# Маршруты приложения; само приложение собирает create_app()
+api = Blueprint('api', __name__, cli_group=None)
+
+# JSON-провайдер (orjson, если установлен) и сжатие ответов больше COMPRESS_MIN_SIZE байт
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'orjson')
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
 
 SECRET_KEY = os.environ.get("SECRET_KEY", "vsu_glimpse_nelly")
+# Токен для /metrics и /api/stats/* (заголовок Authorization: Bearer <токен>); без него эти эндпоинты выключены
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
-IMAGE_STORAGE_PATH = 'C:/Users/agapo/PycharmProjects/Glimpse/images'
-BASE_URL = 'http://192.168.0.102:5000'
+# Каталог изображений по умолчанию - images/ рядом с кодом
+IMAGE_STORAGE_PATH = os.environ.get('IMAGE_STORAGE_PATH',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images'))
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
-
-class User(Base):
-    __tablename__ = "users"
-
-    user_id = Column(Integer, primary_key=True, autoincrement=True)
-    username = Column(String(50), unique=True, nullable=False)
-    password = Column(String(255), nullable=False)  # Храним хэш пароля
-    email = Column(String(100), unique=True, nullable=False)
-    profile_pic = Column(String(255), nullable=True)  # Путь к файлу изображения
-    status = Column(String(100), default="")
-
-    posts = relationship("Post", back_populates="user")
-    comments = relationship("Comment", back_populates="user")
-    likes = relationship("Like", back_populates="user")
-
-    def __repr__(self):
-        return f"<User(username='{self.username}', email='{self.email}')>"
-
-
-class Post(Base):
-    __tablename__ = "posts"
-
-    post_id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
-    image_path = Column(String(255), nullable=False)
-    caption = Column(Text, nullable=True)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow())
-
-    user = relationship("User", back_populates="posts")
-    comments = relationship("Comment", back_populates="post")
-    likes = relationship("Like", back_populates="post")
-
-    def __repr__(self):
-        return f"<Post(post_id={self.post_id}, caption='{self.caption}')>"
-
-
-class Friendship(Base):
-    __tablename__ = "friendships"
-
-    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
-    friend_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
-
-    __table_args__ = (
-        UniqueConstraint('user_id', 'friend_id', name='unique_friendship'),
-    )
-
-    user = relationship("User", foreign_keys=[user_id])
-    friend = relationship("User", foreign_keys=[friend_id])
-
-
-class Comment(Base):
-    __tablename__ = "comments"
-
-    comment_id = Column(Integer, primary_key=True, autoincrement=True)
-    post_id = Column(Integer, ForeignKey("posts.post_id"), nullable=False)
-    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
-    text = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow())
-
-    post = relationship("Post", back_populates="comments")
-    user = relationship("User", back_populates="comments")
-
-    def __repr__(self):
-        return f"<Comment(comment_id={self.comment_id}, text='{self.text}')>"
-
-
-class Like(Base):
-    __tablename__ = "likes"
-
-    post_id = Column(Integer, ForeignKey("posts.post_id"), primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
-
-    post = relationship("Post", back_populates="likes")
-    user = relationship("User", back_populates="likes")
-
-
-Base.metadata.drop_all(engine)
-Base.metadata.create_all(engine)
-
-Session = sessionmaker(bind=engine)
-session = Session()
-
-
-@app.route('/')
+# Пул процессов для обработки загрузок (IMAGE_WORKERS=0 - обработка в потоке запроса)
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 64))
+# Дополнительно сохранять WebP-версии всех размеров
+IMAGE_WEBP = os.environ.get('IMAGE_WEBP', '0') == '1'
+# Предел размера исходного изображения в пикселях; больше - отклоняем по заголовку, не декодируя
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+
+# Имена файлов изображений уникальны и не меняются, поэтому клиенты могут кэшировать их бессрочно
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 365 * 24 * 3600))
+# Кэш горячих изображений в памяти: общий объем, предел для одного файла и число записей
+IMAGE_MEMORY_CACHE_BYTES = int(os.environ.get('IMAGE_MEMORY_CACHE_BYTES', 64 * 1024 * 1024))
+IMAGE_MEMORY_CACHE_MAX_FILE = int(os.environ.get('IMAGE_MEMORY_CACHE_MAX_FILE', 512 * 1024))
+IMAGE_MEMORY_CACHE_ITEMS = int(os.environ.get('IMAGE_MEMORY_CACHE_ITEMS', 10000))
+# Сколько часов сборщик мусора не трогает файлы без ссылок (загрузка могла еще не попасть в пост)
+IMAGE_GC_GRACE_HOURS = int(os.environ.get('IMAGE_GC_GRACE_HOURS', 24))
+# Файл ожидающей загрузки старше этого считается брошенным: его заменяет повторная загрузка,
+# а при старте он удаляется. Должно быть больше времени ожидания задачи в очереди
+IMAGE_UPLOAD_STALE_SECONDS = int(os.environ.get('IMAGE_UPLOAD_STALE_SECONDS', 900))
+
+# Максимум действий в одном запросе /api/batch
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 500))
+
+# Потоковая выдача списков (?format=ndjson): строк за одно чтение из базы и байт в одном куске ответа
+NDJSON_YIELD_PER = int(os.environ.get('NDJSON_YIELD_PER', 500))
+NDJSON_CHUNK_SIZE = int(os.environ.get('NDJSON_CHUNK_SIZE', 64 * 1024))
+
+FEED_PAGE_SIZE = int(os.environ.get('FEED_PAGE_SIZE', 20))
+FEED_MAX_PAGE_SIZE = int(os.environ.get('FEED_MAX_PAGE_SIZE', 100))
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', 50))
+
+# Кэш аутентификации: декодированные токены и неизменяемые поля пользователей живут AUTH_CACHE_TTL секунд
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+
+# Граф дружбы в памяти процесса (FRIENDS_GRAPH_CACHE=1); подходит только для запуска в одном процессе
+FRIENDS_GRAPH_CACHE = os.environ.get('FRIENDS_GRAPH_CACHE', '0') == '1'
+
+# Лента через материализованную таблицу timeline: новый пост сразу раскладывается по лентам подписчиков
+# (fan-out при записи), при добавлении друга в ленту докладываются его последние FEED_FANOUT_BACKFILL постов
+FEED_FANOUT = os.environ.get('FEED_FANOUT', '0') == '1'
+FEED_FANOUT_BACKFILL = int(os.environ.get('FEED_FANOUT_BACKFILL', 1000))
+
+# Отложенная запись лайков: изменения копятся в памяти и пишутся пачкой раз в LIKE_FLUSH_INTERVAL
+# секунд или при LIKE_FLUSH_MAX_PENDING измененных парах; только для запуска в одном процессе
+LIKE_WRITE_BEHIND = os.environ.get('LIKE_WRITE_BEHIND', '0') == '1'
+LIKE_FLUSH_INTERVAL = float(os.environ.get('LIKE_FLUSH_INTERVAL', 1.0))
+LIKE_FLUSH_MAX_PENDING = int(os.environ.get('LIKE_FLUSH_MAX_PENDING', 1000))
+
+# Поток событий (SSE): пинг раз в SSE_HEARTBEAT секунд, предел соединений на процесс,
+# очередь событий клиента и число последних событий для переподключения с Last-Event-ID
+SSE_HEARTBEAT = int(os.environ.get('SSE_HEARTBEAT', 15))
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 10000))
+SSE_MAX_POSTS = int(os.environ.get('SSE_MAX_POSTS', 200))
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 1000))
+SSE_REPLAY_SIZE = int(os.environ.get('SSE_REPLAY_SIZE', 1000))
+
+# Запросы дольше SLOW_REQUEST_MS печатаются вместе с их SQL и попадают в /api/stats/slow-requests
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_LOG_SIZE = int(os.environ.get('SLOW_REQUEST_LOG_SIZE', 100))
+
+
+metrics = Metrics(slow_request_ms=SLOW_REQUEST_MS, slow_log_size=SLOW_REQUEST_LOG_SIZE)
+
+# Общие для всех приложений процесса: брокер событий, пул обработки изображений, буфер лайков и граф
+# друзей. Граф и буфер лайков хранят данные одной базы, поэтому с ними все приложения процесса
+# должны работать с одной и той же базой (проверяет create_app)
+friends_graph = FriendshipGraph() if FRIENDS_GRAPH_CACHE else None
+event_broker = EventBroker(replay_size=SSE_REPLAY_SIZE)
+# Причина, по которой поток событий в этом процессе отключен (задает gunicorn.conf.py), или None
+event_stream_unavailable = None
+image_jobs = ImageJobs(IMAGE_WORKERS, IMAGE_QUEUE_SIZE, webp=IMAGE_WEBP, max_pixels=IMAGE_MAX_PIXELS,
+                       on_finish=metrics.observe_job)
+
+
+class AppState:
+    """Состояние одного приложения из create_app (app.extensions['glimpse']): хранилище изображений,
+    доступность FTS-поиска и кэши, которые зависят от базы и хранилища этого приложения."""
+
+    def __init__(self, image_store, username_fts):
+        self.image_store = image_store
+        # Полнотекстовый индекс имен пользователей, если база его поддерживает
+        self.username_fts = username_fts
+        self.token_cache = LRUCache(max_items=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+        self.user_cache = LRUCache(max_items=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+        # Запрос (путь, размер, WebP) -> (файл, mtime, ETag, байты или None для больших файлов)
+        self.image_cache = LRUCache(max_items=IMAGE_MEMORY_CACHE_ITEMS, max_bytes=IMAGE_MEMORY_CACHE_BYTES,
+                                    sizeof=lambda entry: len(entry[3]) if entry[3] else 0)
+
+
+def app_state():
+    """Состояние текущего приложения."""
+    return current_app.extensions['glimpse']
+
+
+@api.route('/')
 def index():
     return render_template('index.html')
 
 
-@app.route('/api/registry', methods=['POST'])
+@api.route('/api/registry', methods=['POST'])
 def registry():
     data = request.get_json()
     email = data.get('email')
@@ -150,7 +186,7 @@ def registry():
     return jsonify({'message': 'User registered successfully'}), 201
 
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
     email = data.get('email')
@@ -183,7 +219,7 @@ def login():
         'email': user.email,
         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)  # Срок действия: 1 час
     }
-    token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    token = jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm="HS256")
 
     session.close()
     return jsonify({'token': token}), 200
@@ -199,7 +235,7 @@ def check_password(password, hashed_password):
     return hash_password(password) == hashed_password
 
 
-@app.route('/api/users', methods=['POST'])
+@api.route('/api/users', methods=['POST'])
 def create_user_route():
     """Создает нового пользователя"""
     data = request.get_json()
@@ -232,6 +268,28 @@ def create_user_route():
         session.close()
 
 
+# Пользователь в кэше token_required: только поля, которые не меняются. Изменяемые поля (статус, аватар)
+# читаются из базы, поэтому кэш не устаревает ни в этом, ни в других рабочих процессах и не нуждается
+# в сбросе. Кортеж неизменяем, его безопасно отдавать нескольким потокам сразу
+CurrentUser = namedtuple('CurrentUser', ['user_id', 'username'])
+
+
+def load_current_user(user_id):
+    """Пользователь для token_required (CurrentUser): из кэша или из базы."""
+    user_cache = app_state().user_cache
+    current_user = user_cache.get(user_id)
+    if current_user is None:
+        session = Session()
+        try:
+            row = session.query(User.user_id, User.username).filter_by(user_id=user_id).first()
+        finally:
+            session.close()
+        if row:
+            current_user = CurrentUser(*row)
+            user_cache.set(user_id, current_user)
+    return current_user
+
+
 # Функция для проверки JWT
 def token_required(f):
     @wraps(f)
@@ -242,14 +300,17 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
         try:
-            data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            session = Session()
-            current_user = session.query(User).filter_by(user_id=data['user_id']).first()
+            token_cache = app_state().token_cache
+            data = token_cache.get(token)
+            if data is None or data['exp'] <= time.time():
+                # Просроченный токен повторно проверяем через jwt, чтобы получить ExpiredSignatureError
+                data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
+                token_cache.set(token, data)
+            current_user = load_current_user(data['user_id'])
             if current_user:
                 kwargs['current_user'] = current_user
             else:
                 return jsonify({'message': 'Invalid token: User not found'}), 401
-            session.close()
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired!'}), 401
         except jwt.InvalidTokenError:
@@ -259,24 +320,84 @@ def token_required(f):
     return decorated
 
 
-@app.route('/api/user', methods=['GET'])
+@api.route('/api/user', methods=['GET'])
 @token_required
 def get_user(current_user):
     """Возвращает информацию о пользователе на основе JWT."""
-    user_data = {
-        'user_id': current_user.user_id,
-        'username': current_user.username,
-        'email': current_user.email,
-        'profile_pic': current_user.profile_pic,
-        'status': current_user.status,
-    }
+    session = Session()
+    try:
+        # Статус и аватар меняются, поэтому берем их из базы, а не из кэша аутентификации
+        user = session.query(User).get(current_user.user_id)
+        if user is None:
+            return jsonify({'message': 'Invalid token: User not found'}), 401
+        user_data = {
+            'user_id': user.user_id,
+            'username': user.username,
+            'email': user.email,
+            'profile_pic': user.profile_pic,
+            'status': user.status,
+        }
+    finally:
+        session.close()
     return jsonify(user_data), 200
 
 
-@app.route('/api/users/search', methods=['GET'])
+def metrics_token_required(f):
+    """Пускает к служебной статистике только с METRICS_TOKEN: в ней SQL и пути чужих запросов."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        expected = current_app.config['METRICS_TOKEN']
+        if not expected:
+            return jsonify({'message': 'Not found'}), 404
+        header = request.headers.get('Authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else ''
+        if not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+            return jsonify({'message': 'Invalid metrics token'}), 401
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+@api.route('/api/stats/cache', methods=['GET'])
+@metrics_token_required
+def get_cache_stats_route():
+    """Статистика кэшей процесса: попадания, промахи, hit rate, размер"""
+    state = app_state()
+    return jsonify({
+        'auth_tokens': state.token_cache.stats(),
+        'auth_users': state.user_cache.stats(),
+        'images': state.image_cache.stats(),
+    }), 200
+
+
+@api.route('/api/stats/slow-requests', methods=['GET'])
+@metrics_token_required
+def get_slow_requests_route():
+    """Последние медленные запросы с выполненными в них SQL, новые первыми"""
+    return jsonify(list(reversed(metrics.slow_requests))), 200
+
+
+@api.route('/metrics', methods=['GET'])
+@metrics_token_required
+def metrics_route():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def serialize_user(user):
+    return {
+        'user_id': user['user_id'],
+        'username': user['username'],
+        'email': user['email'],
+        'profile_pic': user['profile_pic'],
+        'status': user['status'],
+    }
+
+
+@api.route('/api/users/search', methods=['GET'])
 @token_required
 def search_users(current_user):
-    """Поиск пользователей по никнейму (исключая текущего пользователя)."""
+    """Поиск пользователей по никнейму (исключая текущего пользователя), постранично (limit и after) или потоком NDJSON."""
     session = Session()
     try:
         # Получаем параметр поиска из query string
@@ -288,24 +409,32 @@ def search_users(current_user):
         if len(query) < 2:
             return jsonify({'message': 'Query must be at least 2 characters long'}), 400
 
-        # Ищем пользователей по никнейму (частичное совпадение, регистронезависимо)
+        try:
+            limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+            cursor = request.args.get('after')
+            after = tuple(int(part) for part in cursor.split('_', 1)) if cursor else None
+            if limit < 1 or (after and len(after) != 2):
+                raise ValueError('invalid page')
+        except ValueError:
+            return jsonify({'message': 'Invalid limit or cursor'}), 400
+
+        if wants_ndjson():
+            return stream_ndjson(
+                lambda stream_session: search_usernames(stream_session, query, current_user.user_id, None, after,
+                                                        fts=app_state().username_fts, yield_per=NDJSON_YIELD_PER),
+                serialize_user, 'поиск пользователей')
+
+        # Ищем пользователей по никнейму (частичное совпадение, регистронезависимо) по индексу;
+        # сначала точные совпадения, затем по префиксу, затем по подстроке.
         # Исключаем текущего пользователя из результатов
-        users = session.query(User).filter(
-            User.username.ilike(f'%{query}%'),
-            User.user_id != current_user.user_id
-        ).all()
-
-        users_list = []
-        for user in users:
-            users_list.append({
-                'user_id': user.user_id,
-                'username': user.username,
-                'email': user.email,
-                'profile_pic': user.profile_pic,
-                'status': user.status,
-            })
+        users = search_usernames(session, query, current_user.user_id, limit + 1, after, fts=app_state().username_fts)
+        users, next_cursor = paginate(users, limit, lambda user: (user['rank'], user['user_id']),
+                                      encode=lambda rank, user_id: f'{rank}_{user_id}')
 
-        return jsonify(users_list), 200
+        response = jsonify([serialize_user(user) for user in users])
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
 
     except Exception as e:
         print(f"Ошибка при поиске пользователей: {e}")
@@ -314,7 +443,7 @@ def search_users(current_user):
         session.close()
 
 
-@app.route('/api/users/<int:user_id>/status', methods=['PUT'])
+@api.route('/api/users/<int:user_id>/status', methods=['PUT'])
 def update_user_status_route(user_id):
     """Обновляет статус пользователя"""
     data = request.get_json()
@@ -345,7 +474,74 @@ def update_user_status_route(user_id):
         session.close()
 
 
-@app.route('/api/posts', methods=['POST'])
+def publish_post(post):
+    """Новый пост - подписчикам постов автора."""
+    event_broker.publish(f'posts:{post.user_id}', {
+        'type': 'post', 'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path,
+        'caption': post.caption, 'timestamp': post.timestamp.isoformat()})
+
+
+def publish_comment(comment):
+    """Новый комментарий - тем, кто смотрит пост."""
+    event_broker.publish(f'post:{comment.post_id}', {
+        'type': 'comment', 'post_id': comment.post_id, 'comment_id': comment.comment_id,
+        'user_id': comment.user_id, 'text': comment.text, 'timestamp': comment.timestamp.isoformat()})
+
+
+def publish_like(post_id, user_id, liked):
+    """Лайк или его снятие - тем, кто смотрит пост."""
+    event_broker.publish(f'post:{post_id}', {'type': 'like', 'post_id': post_id, 'user_id': user_id,
+                                             'liked': liked})
+
+
+def publish_friend(user_id, friend_id):
+    """Новый друг - потокам самого пользователя, чтобы они подписались на посты друга."""
+    event_broker.publish(f'user:{user_id}', {'type': 'friend', 'user_id': user_id, 'friend_id': friend_id})
+
+
+def fan_out_post(session, post):
+    """Раскладывает пост по лентам всех, кто добавил автора в друзья, одним INSERT ... SELECT."""
+    session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'],
+        select(Friendship.user_id, literal(post.post_id), literal(post.user_id), literal(post.timestamp, DateTime))
+        .where(Friendship.friend_id == post.user_id)))
+
+
+def backfill_timeline(session, user_id, friend_id):
+    """Добавляет в ленту user_id последние посты нового друга."""
+    already_there = exists().where(TimelineEntry.user_id == user_id, TimelineEntry.post_id == Post.post_id)
+    recent_posts = select(literal(user_id), Post.post_id, Post.user_id, Post.timestamp).where(
+        Post.user_id == friend_id, ~already_there).order_by(Post.timestamp.desc()).limit(FEED_FANOUT_BACKFILL)
+    session.execute(insert(TimelineEntry).from_select(['user_id', 'post_id', 'author_id', 'timestamp'],
+                                                      recent_posts))
+
+
+def rebuild_timeline(session):
+    """Заполняет timeline заново по постам и дружбам. Возвращает число записей."""
+    session.query(TimelineEntry).delete(synchronize_session=False)
+    result = session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'],
+        select(Friendship.user_id, Post.post_id, Post.user_id, Post.timestamp)
+        .join(Friendship, Friendship.friend_id == Post.user_id)))
+    return result.rowcount
+
+
+@api.cli.command('rebuild-timeline')
+def rebuild_timeline_command():
+    """Пересобирает материализованные ленты (после включения FEED_FANOUT или загрузки данных в обход API)."""
+    session = Session()
+    try:
+        count = rebuild_timeline(session)
+        session.commit()
+        print(f"Лента пересобрана: {count} записей")
+    except Exception as e:
+        session.rollback()
+        print(f"Ошибка при пересборке ленты: {e}")
+    finally:
+        session.close()
+
+
+@api.route('/api/posts', methods=['POST'])
 def create_post_route():
     """Создает новый пост"""
     data = request.get_json()
@@ -358,15 +554,15 @@ def create_post_route():
 
     session = Session()
     try:
-        new_post = Post(user_id=user_id, image_path=image_path, caption=caption)
-        session.add(new_post)
         try:
+            new_post = create_post(session, user_id, image_path, caption)
             session.commit()
         except Exception as e:
             session.rollback()
             print(f"Ошибка при создании поста: {e}")
             new_post = None
         if new_post:
+            publish_post(new_post)
             return jsonify({'post_id': new_post.post_id, 'message': 'Post created successfully'}), 201
         else:
             return jsonify({'message': 'Failed to create post'}), 500
@@ -374,7 +570,17 @@ def create_post_route():
         session.close()
 
 
-@app.route('/api/posts/<int:post_id>/caption', methods=['PUT'])
+def create_post(session, user_id, image_path, caption):
+    """Добавляет пост (и при FEED_FANOUT раскладывает его по лентам) в текущую транзакцию."""
+    new_post = Post(user_id=user_id, image_path=image_path, caption=caption)
+    session.add(new_post)
+    if FEED_FANOUT:
+        session.flush()
+        fan_out_post(session, new_post)
+    return new_post
+
+
+@api.route('/api/posts/<int:post_id>/caption', methods=['PUT'])
 def update_post_caption_route(post_id):
     """Обновляет подпись (caption) поста по ID"""
     data = request.get_json()
@@ -401,7 +607,17 @@ def update_post_caption_route(post_id):
         session.close()
 
 
-@app.route('/api/friends', methods=['POST'])
+def parse_ids(*values):
+    """Приводит идентификаторы из JSON (число или строка с числом) к int. ValueError, если это не так."""
+    ids = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(f'Invalid id: {value!r}')
+        ids.append(int(value))
+    return ids
+
+
+@api.route('/api/friends', methods=['POST'])
 def add_friend_route():
     """Добавляет пользователя в друзья"""
     data = request.get_json()
@@ -410,27 +626,95 @@ def add_friend_route():
 
     if not user_id or not friend_id:
         return jsonify({'message': 'Missing required fields'}), 400
+    # Приводим к int до записи: иначе нечисловой id успел бы попасть в базу
+    try:
+        user_id, friend_id = parse_ids(user_id, friend_id)
+    except ValueError:
+        return jsonify({'message': 'Invalid user_id or friend_id'}), 400
 
     session = Session()
     try:
-        success = False
-        friendship = Friendship(user_id=user_id, friend_id=friend_id)
-        session.add(friendship)
+        # Повторное добавление не ошибка: строка просто не вставляется
         try:
+            inserted = insert_ignore(session, Friendship, [{'user_id': user_id, 'friend_id': friend_id}])
+            if inserted and FEED_FANOUT:
+                backfill_timeline(session, user_id, friend_id)
             session.commit()
-            success = True
         except Exception as e:
             session.rollback()
             print(f"Ошибка при добавлении в друзья: {e}")
-        if success:
-            return jsonify({'message': 'Friend added successfully'}), 200
-        else:
             return jsonify({'message': 'Failed to add friend'}), 500
+        if inserted and friends_graph:
+            friends_graph.add(user_id, friend_id)
+        if inserted:
+            publish_friend(user_id, friend_id)
+        return jsonify({'message': 'Friend added successfully'}), 200
     finally:
         session.close()
 
 
-@app.route('/api/comments', methods=['POST'])
+def insert_ignore(session, model, rows):
+    """INSERT ... ON CONFLICT DO NOTHING для rows в текущей транзакции.
+
+    Возвращает множество первичных ключей действительно вставленных строк (уже существующие пропускаются).
+    """
+    if not rows:
+        return set()
+    key_columns = model.__table__.primary_key.columns
+    dialect = session.get_bind().dialect
+    if dialect.name in ('sqlite', 'postgresql'):
+        if dialect.name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(model).values(rows).on_conflict_do_nothing()
+        if dialect.insert_returning:
+            return set(map(tuple, session.execute(statement.returning(*key_columns))))
+        session.execute(statement)
+        return {tuple(row[column.key] for column in key_columns) for row in rows}
+
+    # Остальные СУБД: по строке в точке сохранения, чтобы дубликат не откатывал всю транзакцию
+    inserted = set()
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(insert(model).values(row))
+            inserted.add(tuple(row[column.key] for column in key_columns))
+        except IntegrityError:
+            pass
+    return inserted
+
+
+def increment_post_counter(session, post_id, counter, delta):
+    """Меняет счетчик поста в текущей транзакции атомарным UPDATE ... SET counter = counter + delta."""
+    session.query(Post).filter(Post.post_id == post_id).update({counter: counter + delta},
+                                                                synchronize_session=False)
+
+
+def recount_post_counters(session):
+    """Пересчитывает like_count и comment_count всех постов по таблицам likes и comments."""
+    likes_count = select(func.count()).where(Like.post_id == Post.post_id).scalar_subquery()
+    comments_count = select(func.count()).where(Comment.post_id == Post.post_id).scalar_subquery()
+    return session.query(Post).update({Post.like_count: likes_count, Post.comment_count: comments_count},
+                                      synchronize_session=False)
+
+
+@api.cli.command('recount-counters')
+def recount_counters_command():
+    """Сверяет денормализованные счетчики постов с фактическими лайками и комментариями."""
+    session = Session()
+    try:
+        updated = recount_post_counters(session)
+        session.commit()
+        print(f"Пересчитаны счетчики для {updated} постов")
+    except Exception as e:
+        session.rollback()
+        print(f"Ошибка при пересчете счетчиков: {e}")
+    finally:
+        session.close()
+
+
+@api.route('/api/comments', methods=['POST'])
 def add_comment_route():
     """Добавляет комментарий к посту (endpoint)."""
     data = request.get_json()
@@ -443,15 +727,15 @@ def add_comment_route():
 
     session = Session()
     try:
-        new_comment = Comment(post_id=post_id, user_id=user_id, text=text)
-        session.add(new_comment)
         try:
+            new_comment = create_comment(session, post_id, user_id, text)
             session.commit()
         except Exception as e:
             session.rollback()
             print(f"Ошибка при добавлении комментария: {e}")
             new_comment = None
         if new_comment:
+            publish_comment(new_comment)
             return jsonify({'comment_id': new_comment.comment_id, 'message': 'Comment added successfully'}), 201
         else:
             return jsonify({'message': 'Failed to add comment'}), 500
@@ -459,7 +743,15 @@ def add_comment_route():
         session.close()
 
 
-@app.route('/api/likes', methods=['POST'])
+def create_comment(session, post_id, user_id, text):
+    """Добавляет комментарий и увеличивает счетчик комментариев поста в текущей транзакции."""
+    new_comment = Comment(post_id=post_id, user_id=user_id, text=text)
+    session.add(new_comment)
+    increment_post_counter(session, post_id, Post.comment_count, 1)
+    return new_comment
+
+
+@api.route('/api/likes', methods=['POST'])
 def like_post_route():
     """Ставит лайк посту"""
     data = request.get_json()
@@ -468,64 +760,268 @@ def like_post_route():
 
     if not post_id or not user_id:
         return jsonify({'message': 'Missing required fields'}), 400
+    try:
+        post_id, user_id = parse_ids(post_id, user_id)
+    except ValueError:
+        return jsonify({'message': 'Invalid post_id or user_id'}), 400
 
     session = Session()
     try:
-        success = False
-        like = Like(post_id=post_id, user_id=user_id)
-        session.add(like)
+        # Повторный лайк (двойное нажатие) не ошибка: строка не вставляется, счетчик не меняется
         try:
+            changed = set_like(session, post_id, user_id, True)
             session.commit()
-            success = True
         except Exception as e:
             session.rollback()
             print(f"Ошибка при лайке поста: {e}")
-        if success:
-            return jsonify({'message': 'Post liked successfully'}), 200
-        else:
             return jsonify({'message': 'Failed to like post'}), 500
+        if changed:
+            publish_like(post_id, user_id, True)
+        return jsonify({'message': 'Post liked successfully'}), 200
     finally:
         session.close()
 
 
-@app.route('/api/likes/<int:post_id>/<int:user_id>', methods=['DELETE'])
+@api.route('/api/likes/<int:post_id>/<int:user_id>', methods=['DELETE'])
 def unlike_post_route(post_id, user_id):
     """Удаляет лайк с поста"""
     session = Session()
     try:
-        like = session.query(Like).filter_by(post_id=post_id, user_id=user_id).first()
+        try:
+            changed = set_like(session, post_id, user_id, False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"Ошибка при удалении лайка: {e}")
+            return jsonify({'message': 'Failed to remove like'}), 500
+        if not changed:
+            return jsonify({'message': 'Like not found'}), 404
+        publish_like(post_id, user_id, False)
+        return jsonify({'message': 'Like removed successfully'}), 200
+    finally:
+        session.close()
 
-        if like:
-            session.delete(like)
-            try:
-                session.commit()
-                return jsonify({'message': 'Like removed successfully'}), 200
-            except Exception as e:
-                session.rollback()
-                print(f"Ошибка при удалении лайка: {e}")
-                return jsonify({'message': 'Failed to remove like'}), 500
+
+def set_like(session, post_id, user_id, liked):
+    """Ставит или снимает лайк в текущей транзакции (или в буфере лайков). Возвращает True, если состояние изменилось."""
+    if like_buffer:
+        return like_buffer.set(post_id, user_id, liked) != liked
+    if liked:
+        changed = bool(insert_ignore(session, Like, [{'post_id': post_id, 'user_id': user_id}]))
+    else:
+        changed = session.query(Like).filter_by(post_id=post_id, user_id=user_id).delete(
+            synchronize_session=False) > 0
+    if changed:
+        increment_post_counter(session, post_id, Post.like_count, 1 if liked else -1)
+    return changed
+
+
+def apply_like_changes(session, to_add, to_remove):
+    """Вставляет и удаляет лайки (пары (post_id, user_id)) и меняет like_count на число реально измененных строк."""
+    added = insert_ignore(session, Like, [{'post_id': post_id, 'user_id': user_id} for post_id, user_id in to_add])
+    removed = set()
+    if to_remove:
+        statement = delete(Like).where(tuple_(Like.post_id, Like.user_id).in_(to_remove))
+        if session.get_bind().dialect.delete_returning:
+            removed = set(map(tuple, session.execute(statement.returning(Like.post_id, Like.user_id))))
         else:
-            return jsonify({'message': 'Like not found'}), 404
+            session.execute(statement)
+            removed = set(to_remove)
+    deltas = Counter(post_id for post_id, _ in added)
+    deltas.subtract(post_id for post_id, _ in removed)
+    for post_id, delta in deltas.items():
+        if delta:
+            increment_post_counter(session, post_id, Post.like_count, delta)
+
+
+def fetch_liked(post_id, user_id):
+    """Есть ли лайк в базе (для буфера лайков). Своя короткая сессия: вызывается и вне запроса Flask."""
+    session = Session.session_factory()
+    try:
+        return session.query(Like.post_id).filter_by(post_id=post_id, user_id=user_id).first() is not None
     finally:
         session.close()
 
 
-@app.route('/api/users/<int:user_id>/post', methods=['GET'])
+like_buffer = LikeBuffer(Session, fetch_liked, apply_like_changes, flush_interval=LIKE_FLUSH_INTERVAL,
+                         max_pending=LIKE_FLUSH_MAX_PENDING) if LIKE_WRITE_BEHIND else None
+
+
+def read_with_likes(query, post_ids, viewer_id=None):
+    """Выполняет query() и добавляет незаписанные изменения из буфера лайков.
+
+    Возвращает (результат, {post_id: поправка к like_count}, {post_id: лайкнул ли viewer_id}).
+    """
+    if like_buffer:
+        return like_buffer.read(query, post_ids, viewer_id)
+    return query(), {}, {}
+
+
+BATCH_FIELDS = {
+    'like': ('post_id', 'user_id'),
+    'unlike': ('post_id', 'user_id'),
+    'comment': ('post_id', 'user_id'),
+    'friend': ('user_id', 'friend_id'),
+}
+
+
+@api.route('/api/batch', methods=['POST'])
+def batch_route():
+    """Применяет пачку действий (like, unlike, comment, friend) в одной транзакции.
+
+    Тело: {"operations": [{"type": "like", "post_id": 1, "user_id": 2}, ...]}. В ответе результат
+    каждого действия в том же порядке: created, exists, deleted, not_found или invalid.
+    Действия над одной парой применяются по порядку: like и затем unlike дают пост без лайка.
+    """
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'Missing operations'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'message': f'Too many operations (max {BATCH_MAX_OPERATIONS})'}), 400
+
+    results = [None] * len(operations)
+    valid = []
+    for index, operation in enumerate(operations):
+        operation_type = operation.get('type') if isinstance(operation, dict) else None
+        fields = BATCH_FIELDS.get(operation_type) if isinstance(operation_type, str) else None
+        # bool в Python - подкласс int, но true/false из JSON не идентификаторы
+        if fields is None or not all(isinstance(operation.get(field), int) and not isinstance(operation[field], bool)
+                                     for field in fields) or \
+                (operation['type'] == 'comment' and not (isinstance(operation.get('text'), str) and operation['text'])):
+            results[index] = {'status': 'invalid', 'message': 'Unknown type or missing fields'}
+        else:
+            valid.append((index, operation))
+
+    session = Session()
+    try:
+        # Проверяем ссылки двумя запросами, а не по запросу на действие
+        post_ids = {operation['post_id'] for _, operation in valid if 'post_id' in operation}
+        user_ids = {operation[field] for _, operation in valid for field in ('user_id', 'friend_id')
+                    if field in operation}
+        existing_posts = {post_id for post_id, in session.query(Post.post_id).filter(Post.post_id.in_(post_ids))}
+        existing_users = {user_id for user_id, in session.query(User.user_id).filter(User.user_id.in_(user_ids))}
+
+        likes, comments, friendships = [], [], []
+        for index, operation in valid:
+            missing_post = 'post_id' in operation and operation['post_id'] not in existing_posts
+            missing_user = any(operation[field] not in existing_users for field in ('user_id', 'friend_id')
+                               if field in operation)
+            if missing_post or missing_user:
+                results[index] = {'status': 'not_found'}
+            elif operation['type'] in ('like', 'unlike'):
+                likes.append((index, operation))
+            elif operation['type'] == 'comment':
+                comments.append((index, operation))
+            else:
+                friendships.append((index, operation))
+
+        comment_deltas = Counter()
+
+        # Лайки: по текущему состоянию пар считаем итоговое, в базу пишем только разницу
+        like_keys = {(operation['post_id'], operation['user_id']) for _, operation in likes}
+
+        def query_liked():
+            return set(map(tuple, session.query(Like.post_id, Like.user_id).filter(
+                tuple_(Like.post_id, Like.user_id).in_(like_keys)))) if like_keys else set()
+
+        if like_buffer:
+            # С отложенной записью текущее состояние - база с поправками из буфера
+            liked, buffered = like_buffer.states(query_liked, like_keys)
+            for key, state in buffered.items():
+                if state:
+                    liked.add(key)
+                else:
+                    liked.discard(key)
+        else:
+            liked = query_liked()
+        state = set(liked)
+        for index, operation in likes:
+            key = (operation['post_id'], operation['user_id'])
+            if operation['type'] == 'like':
+                results[index] = {'status': 'exists' if key in state else 'created'}
+                state.add(key)
+            else:
+                results[index] = {'status': 'deleted' if key in state else 'not_found'}
+                state.discard(key)
+        # В буфер изменения попадают только после commit, чтобы не записать лайки из откаченного пакета
+        if not like_buffer:
+            apply_like_changes(session, state - liked, liked - state)
+
+        # Комментарии вставляются одной пачкой, id получаем после flush
+        new_comments = [Comment(post_id=operation['post_id'], user_id=operation['user_id'], text=operation['text'])
+                        for _, operation in comments]
+        session.add_all(new_comments)
+        session.flush()
+        for (index, _), comment in zip(comments, new_comments):
+            results[index] = {'status': 'created', 'comment_id': comment.comment_id}
+        comment_deltas.update(comment.post_id for comment in new_comments)
+
+        friend_keys = {(operation['user_id'], operation['friend_id']) for _, operation in friendships}
+        friends_before = set(map(tuple, session.query(Friendship.user_id, Friendship.friend_id).filter(
+            tuple_(Friendship.user_id, Friendship.friend_id).in_(friend_keys)))) if friend_keys else set()
+        for index, operation in friendships:
+            key = (operation['user_id'], operation['friend_id'])
+            results[index] = {'status': 'exists' if key in friends_before else 'created'}
+            friends_before.add(key)
+        added_friendships = insert_ignore(session, Friendship, [{'user_id': user_id, 'friend_id': friend_id}
+                                                               for user_id, friend_id in friend_keys])
+        if FEED_FANOUT:
+            for user_id, friend_id in added_friendships:
+                backfill_timeline(session, user_id, friend_id)
+
+        for post_id, delta in comment_deltas.items():
+            increment_post_counter(session, post_id, Post.comment_count, delta)
+        session.commit()
+
+        if like_buffer:
+            for post_id, user_id in state - liked:
+                like_buffer.set(post_id, user_id, True)
+            for post_id, user_id in liked - state:
+                like_buffer.set(post_id, user_id, False)
+        for user_id, friend_id in added_friendships:
+            publish_friend(user_id, friend_id)
+        for comment in new_comments:
+            publish_comment(comment)
+        for index, operation in valid:
+            if operation['type'] in ('like', 'unlike') and results[index]['status'] in ('created', 'deleted'):
+                publish_like(operation['post_id'], operation['user_id'], operation['type'] == 'like')
+    except Exception as e:
+        session.rollback()
+        print(f"Ошибка при выполнении пакета действий: {e}")
+        return jsonify({'message': 'Failed to apply batch'}), 500
+    finally:
+        session.close()
+
+    if friends_graph:
+        for user_id, friend_id in added_friendships:
+            friends_graph.add(user_id, friend_id)
+    return jsonify({'results': results}), 200
+
+
+def today_range():
+    """Полуоткрытый интервал [начало сегодняшнего дня, начало завтрашнего) для сравнения с Post.timestamp по индексу."""
+    start = datetime.datetime.combine(date.today(), datetime.time.min)
+    return start, start + datetime.timedelta(days=1)
+
+
+@api.route('/api/users/<int:user_id>/post', methods=['GET'])
 def get_user_post_route(user_id):
     """Получает пост пользователя за сегодняшнюю дату"""
     session = Session()
     try:
-        today = date.today()
-        posts = session.query(Post).filter(
+        # Сравнение с границами дня, а не func.date(timestamp), - поиск по индексу (user_id, timestamp)
+        start, end = today_range()
+        # Предполагаем, что у пользователя может быть только один пост в день,
+        # поэтому возвращаем только первый (самый поздний)
+        post = session.query(Post).filter(
             Post.user_id == user_id,
-            func.date(Post.timestamp) == today
-        ).order_by(Post.timestamp.desc()).all()
+            Post.timestamp >= start,
+            Post.timestamp < end
+        ).order_by(Post.timestamp.desc()).first()
 
         post_list = []
-        if posts:
-            # Предполагаем, что у пользователя может быть только один пост в день,
-            # поэтому возвращаем только первый (самый поздний)
-            post = posts[0]
+        if post:
             post_list = [
                 {'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path,
                  'caption': post.caption,
@@ -540,17 +1036,163 @@ def get_user_post_route(user_id):
         session.close()
 
 
-@app.route('/api/friends/<int:user_id>/posts', methods=['GET'])
-def get_friends_posts_route(user_id):
-    """Получает посты друзей пользователя"""
+def query_friends_today_posts(session, user_id):
+    """Последний сегодняшний пост каждого друга пользователя (ROW_NUMBER по автору)."""
+    start, end = today_range()
+    # Нумеруем сегодняшние посты каждого друга от новых к старым и берем первый
+    ranked = select(
+        Post.post_id,
+        func.row_number().over(partition_by=Post.user_id,
+                               order_by=(Post.timestamp.desc(), Post.post_id.desc())).label('position')
+    ).join(Friendship, Post.user_id == Friendship.friend_id).where(
+        Friendship.user_id == user_id,
+        Post.timestamp >= start,
+        Post.timestamp < end
+    ).subquery()
+    return session.query(Post).join(ranked, ranked.c.post_id == Post.post_id).filter(
+        ranked.c.position == 1).options(joinedload(Post.user)).order_by(Post.timestamp.desc())
+
+
+def serialize_post_with_author(post):
+    return {'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path,
+            'caption': post.caption, 'timestamp': post.timestamp.isoformat(),
+            'author': {'user_id': post.user.user_id, 'username': post.user.username,
+                       'profile_pic': post.user.profile_pic}}
+
+
+@api.route('/api/friends/<int:user_id>/today', methods=['GET'])
+def get_friends_today_posts_route(user_id):
+    """Последний сегодняшний пост каждого друга пользователя одним запросом"""
     session = Session()
     try:
-        posts = session.query(Post).join(Friendship, Post.user_id == Friendship.friend_id).filter(
-            Friendship.user_id == user_id).order_by(Post.timestamp.desc()).all()
-        post_list = [
-            {'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path, 'caption': post.caption,
-             'timestamp': post.timestamp.isoformat()} for post in posts]
+        posts = query_friends_today_posts(session, user_id).all()
+        post_list = [serialize_post_with_author(post) for post in posts]
         return jsonify(post_list), 200
+    except Exception as e:
+        print(f"Ошибка при получении сегодняшних постов друзей: {e}")
+        return jsonify({'message': 'Failed to get friends posts for today'}), 500
+    finally:
+        session.close()
+
+
+def encode_cursor(timestamp, row_id):
+    """Кодирует курсор пагинации из пары (timestamp, id)."""
+    return f'{timestamp.isoformat()}_{row_id}'
+
+
+def decode_cursor(cursor):
+    """Разбирает курсор пагинации. Бросает ValueError для некорректного значения."""
+    timestamp, row_id = cursor.rsplit('_', 1)
+    return datetime.datetime.fromisoformat(timestamp), int(row_id)
+
+
+def parse_page_args(cursor_arg='before', args=None):
+    """Читает limit и курсор из query string (args, по умолчанию запроса Flask). Бросает ValueError для некорректных значений."""
+    args = request.args if args is None else args
+    limit = int(args.get('limit', FEED_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    cursor = args.get(cursor_arg)
+    return min(limit, FEED_MAX_PAGE_SIZE), decode_cursor(cursor) if cursor else None
+
+
+def wants_ndjson(args=None, accept_mimetypes=None):
+    """Клиент просит потоковый NDJSON: ?format=ndjson или Accept: application/x-ndjson."""
+    args = request.args if args is None else args
+    accept_mimetypes = request.accept_mimetypes if accept_mimetypes is None else accept_mimetypes
+    return args.get('format') == 'ndjson' or \
+        accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def stream_ndjson(load_rows, serialize, error_message):
+    """Ответ application/x-ndjson: по объекту JSON на строку.
+
+    load_rows(session) возвращает итератор строк (запрос с yield_per), serialize превращает строку в dict.
+    У потока своя сессия: сессия запроса закрывается раньше, чем клиент дочитает ответ.
+    """
+    # Генератор выполняется после выхода из контекста приложения, поэтому провайдер берем заранее
+    json_provider = current_app.json
+
+    def generate():
+        session = Session.session_factory()
+        try:
+            chunk, size = [], 0
+            for row in load_rows(session):
+                line = json_provider.dumps(serialize(row)) + '\n'
+                chunk.append(line)
+                size += len(line)
+                if size >= NDJSON_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
+            if chunk:
+                yield ''.join(chunk)
+        except Exception as e:
+            # Статус уже отправлен, поэтому просто обрываем поток
+            print(f"Ошибка при потоковой выдаче ({error_message}): {e}")
+        finally:
+            session.close()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def serialize_post(post):
+    return {'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path, 'caption': post.caption,
+            'timestamp': post.timestamp.isoformat()}
+
+
+def query_friends_posts(session, user_id, before=None, limit=None):
+    """Посты друзей пользователя от новых к старым, начиная после курсора before.
+
+    При FEED_FANOUT=1 читается диапазон ленты пользователя в timeline вместо соединения с friendships.
+    """
+    if FEED_FANOUT:
+        query = session.query(Post).join(TimelineEntry, TimelineEntry.post_id == Post.post_id).filter(
+            TimelineEntry.user_id == user_id)
+        if before:
+            timestamp, post_id = before
+            query = query.filter(or_(TimelineEntry.timestamp < timestamp,
+                                     and_(TimelineEntry.timestamp == timestamp, TimelineEntry.post_id < post_id)))
+        return query.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).limit(limit)
+
+    query = session.query(Post).join(Friendship, Post.user_id == Friendship.friend_id).filter(
+        Friendship.user_id == user_id)
+    if before:
+        timestamp, post_id = before
+        query = query.filter(or_(Post.timestamp < timestamp,
+                                 and_(Post.timestamp == timestamp, Post.post_id < post_id)))
+    return query.order_by(Post.timestamp.desc(), Post.post_id.desc()).limit(limit)
+
+
+def paginate(rows, limit, key, encode=encode_cursor):
+    """Отрезает лишнюю строку выборки limit + 1 и возвращает (строки, курсор следующей страницы)."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode(*key(rows[-1]))
+
+
+@api.route('/api/friends/<int:user_id>/posts', methods=['GET'])
+def get_friends_posts_route(user_id):
+    """Получает посты друзей пользователя постранично (параметры limit и before) или потоком NDJSON"""
+    try:
+        limit, before = parse_page_args()
+    except ValueError:
+        return jsonify({'message': 'Invalid limit or cursor'}), 400
+
+    if wants_ndjson():
+        # Вся лента после курсора одним потоком, без limit, с постоянным расходом памяти
+        return stream_ndjson(lambda session: query_friends_posts(session, user_id, before).yield_per(NDJSON_YIELD_PER),
+                             serialize_post, 'посты друзей')
+
+    session = Session()
+    try:
+        posts = query_friends_posts(session, user_id, before, limit + 1).all()
+        posts, next_cursor = paginate(posts, limit, lambda post: (post.timestamp, post.post_id))
+        response = jsonify([serialize_post(post) for post in posts])
+        # Курсор следующей страницы передаем в заголовке, чтобы тело ответа осталось списком
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
     except Exception as e:
         print(f"Ошибка при получении постов друзей: {e}")
         return jsonify({'message': 'Failed to get friends posts'}), 500
@@ -558,30 +1200,97 @@ def get_friends_posts_route(user_id):
         session.close()
 
 
-@app.route('/api/friends/<int:user_id>', methods=['GET'])
-@token_required
-def get_friends(current_user, user_id):
-    """Возвращает список друзей пользователя (только взаимные)."""
+def load_liked_ids(session, post_ids, viewer_id):
+    """Какие из постов post_ids лайкнул viewer_id, одним запросом."""
+    if not post_ids:
+        return set()
+    return {post_id for post_id, in session.query(Like.post_id).filter(
+        Like.post_id.in_(post_ids), Like.user_id == viewer_id)}
+
+
+def hydrate_posts(posts, liked_ids, like_deltas=None, liked_overrides=None):
+    """Собирает карточки постов с автором, счетчиками и отметкой лайка зрителя.
+
+    like_deltas и liked_overrides - незаписанные изменения из буфера лайков (read_with_likes).
+    """
+    like_deltas = like_deltas or {}
+    liked_overrides = liked_overrides or {}
+    return [
+        {'post_id': post.post_id, 'user_id': post.user_id, 'image_path': post.image_path, 'caption': post.caption,
+         'timestamp': post.timestamp.isoformat(),
+         'author': {'user_id': post.user.user_id, 'username': post.user.username,
+                    'profile_pic': post.user.profile_pic},
+         'likes_count': post.like_count + like_deltas.get(post.post_id, 0),
+         'comments_count': post.comment_count,
+         'liked': liked_overrides.get(post.post_id, post.post_id in liked_ids)}
+        for post in posts]
+
+
+def load_feed_page(session, user_id, before, limit):
+    """Страница ленты с карточками постов (hydrate_posts) и курсор следующей страницы."""
+    def load_page():
+        # populate_existing: при повторе чтения счетчики уже загруженных постов перечитываются
+        posts = query_friends_posts(session, user_id, before, limit + 1).options(
+            joinedload(Post.user)).populate_existing().all()
+        posts, next_cursor = paginate(posts, limit, lambda post: (post.timestamp, post.post_id))
+        return posts, next_cursor, load_liked_ids(session, [post.post_id for post in posts], user_id)
+
+    (posts, next_cursor, liked_ids), like_deltas, liked_overrides = read_with_likes(
+        load_page, lambda page: [post.post_id for post in page[0]], user_id)
+    return hydrate_posts(posts, liked_ids, like_deltas, liked_overrides), next_cursor
+
+
+@api.route('/api/friends/<int:user_id>/feed', methods=['GET'])
+def get_friends_feed_route(user_id):
+    """Лента друзей с авторами, количеством лайков и комментариев одной страницей (limit и before)"""
+    try:
+        limit, before = parse_page_args()
+    except ValueError:
+        return jsonify({'message': 'Invalid limit or cursor'}), 400
+
     session = Session()
     try:
-        # Находим всех, кто добавил user_id в друзья.
-        friendships1 = session.query(Friendship).filter(Friendship.friend_id == user_id).all()
+        cards, next_cursor = load_feed_page(session, user_id, before, limit)
+        response = jsonify(cards)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    except Exception as e:
+        print(f"Ошибка при получении ленты друзей: {e}")
+        return jsonify({'message': 'Failed to get friends feed'}), 500
+    finally:
+        session.close()
 
-        # Создаем список потенциальных друзей (тех, кто добавил user_id)
-        potential_friend_ids = [friendship.user_id for friendship in friendships1]
 
-        # Теперь, проверяем, добавил ли user_id этих людей в друзья.
-        mutual_friend_ids = []
-        for potential_friend_id in potential_friend_ids:
-            friendship = session.query(Friendship).filter(
-                Friendship.user_id == user_id,
-                Friendship.friend_id == potential_friend_id
-            ).first()
-            if friendship:  # Если такая запись существует, значит, дружба взаимная.
-                mutual_friend_ids.append(potential_friend_id)
+def query_mutual_friends(session, user_id):
+    """Взаимные друзья пользователя одним запросом (self-join таблицы friendships)."""
+    incoming = aliased(Friendship)
+    return session.query(User).join(
+        Friendship, and_(Friendship.user_id == user_id, Friendship.friend_id == User.user_id)
+    ).join(
+        incoming, and_(incoming.user_id == User.user_id, incoming.friend_id == user_id)
+    )
 
-        # Получаем информацию о взаимных друзьях.
-        friends = session.query(User).filter(User.user_id.in_(mutual_friend_ids)).all()
+
+def load_friends_graph(session):
+    """Загружает граф дружбы в память при первом обращении."""
+    friends_graph.ensure_loaded(lambda: session.query(Friendship.user_id, Friendship.friend_id).all())
+
+
+@api.route('/api/friends/<int:user_id>', methods=['GET'])
+@token_required
+def get_friends(current_user, user_id):
+    """Возвращает список друзей пользователя (только взаимные)."""
+    session = Session()
+    try:
+        if friends_graph:
+            # Взаимность проверяем пересечением множеств в памяти, из базы читаем только профили
+            load_friends_graph(session)
+            mutual_friend_ids = friends_graph.mutual(user_id)
+            friends = session.query(User).filter(User.user_id.in_(mutual_friend_ids)).all() \
+                if mutual_friend_ids else []
+        else:
+            friends = query_mutual_friends(session, user_id).all()
 
         friends_list = []
         for friend in friends:
@@ -602,26 +1311,170 @@ def get_friends(current_user, user_id):
         session.close()
 
 
-@app.route('/api/posts/<int:post_id>/comments', methods=['GET'])
+def format_event(item):
+    """Событие брокера в формате text/event-stream."""
+    sequence, topic, event = item
+    return f"id: {sequence}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def parse_stream_args(args, headers):
+    """Посты из ?posts=1,2,3 и номер Last-Event-ID. Бросает ValueError для некорректных значений."""
+    post_ids = {int(post_id) for post_id in args.get('posts', '').split(',') if post_id}
+    last_event_id = int(headers.get('Last-Event-ID', 0))
+    return post_ids, last_event_id
+
+
+def stream_topics(session, user_id, post_ids):
+    """Темы потока пользователя: свои события, посты друзей и события постов post_ids."""
+    if friends_graph:
+        load_friends_graph(session)
+        friend_ids = friends_graph.following(user_id)
+    else:
+        friend_ids = {friend_id for friend_id, in session.query(Friendship.friend_id).filter(
+            Friendship.user_id == user_id)}
+    return {f'user:{user_id}'} | {f'posts:{friend_id}' for friend_id in friend_ids} | \
+           {f'post:{post_id}' for post_id in post_ids}
+
+
+def stream_preamble(subscription, last_event_id):
+    """Начало потока: интервал переподключения и пропущенные с Last-Event-ID события. Возвращает (части, last_sent)."""
+    chunks = [f'retry: {SSE_HEARTBEAT * 1000}\n\n']
+    last_sent = last_event_id
+    if last_event_id:
+        missed = event_broker.replay(last_event_id, subscription.topics)
+        if missed is None:
+            chunks.append('event: resync\ndata: {}\n\n')
+        else:
+            for item in missed:
+                last_sent = item[0]
+                chunks.append(format_event(item))
+    return chunks, last_sent
+
+
+def render_stream_items(subscription, items, last_sent):
+    """Превращает полученные подпиской события в части потока. Возвращает (части, last_sent)."""
+    chunks = []
+    if subscription.overflowed:
+        subscription.overflowed = False
+        chunks.append('event: resync\ndata: {}\n\n')
+    if not items:
+        # Комментарий-пинг держит соединение через прокси и выявляет отключившихся клиентов
+        chunks.append(': ping\n\n')
+    for item in items:
+        if item[0] <= last_sent:
+            continue
+        last_sent = item[0]
+        event = item[2]
+        if event['type'] == 'friend':
+            topic = f"posts:{event['friend_id']}"
+            subscription.topics.add(topic)
+            event_broker.add_topics(subscription, [topic])
+        chunks.append(format_event(item))
+    return chunks, last_sent
+
+
+# X-Accel-Buffering отключает буферизацию ответа в nginx
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+@api.route('/api/stream/<int:user_id>', methods=['GET'])
+def event_stream_route(user_id):
+    """Поток Server-Sent Events: новые посты друзей пользователя и лайки/комментарии к постам из ?posts=1,2,3.
+
+    Поддерживает переподключение с Last-Event-ID; если пропущенные события уже недоступны,
+    первым приходит событие resync, и клиент перечитывает данные обычными запросами.
+    """
+    if event_stream_unavailable:
+        return jsonify({'message': f'Event stream is unavailable: {event_stream_unavailable}'}), 503
+    try:
+        post_ids, last_event_id = parse_stream_args(request.args, request.headers)
+    except ValueError:
+        return jsonify({'message': 'Invalid posts or Last-Event-ID'}), 400
+    if len(post_ids) > SSE_MAX_POSTS:
+        return jsonify({'message': f'Too many posts (max {SSE_MAX_POSTS})'}), 400
+    if event_broker.subscriber_count >= SSE_MAX_CLIENTS:
+        return jsonify({'message': 'Too many open streams, try again later'}), 503
+
+    session = Session()
+    try:
+        topics = stream_topics(session, user_id, post_ids)
+    except Exception as e:
+        print(f"Ошибка при открытии потока событий: {e}")
+        return jsonify({'message': 'Failed to open stream'}), 500
+    finally:
+        # Соединение с базой не держим, пока открыт поток
+        session.close()
+
+    subscription = Subscription(topics, max_queue=SSE_QUEUE_SIZE)
+
+    def generate():
+        # Подписываемся при первом чтении потока: для HEAD генератор не запускается и finally не выполнился бы
+        event_broker.subscribe(subscription, topics)
+        try:
+            chunks, last_sent = stream_preamble(subscription, last_event_id)
+            yield from chunks
+            while True:
+                chunks, last_sent = render_stream_items(subscription, subscription.get(SSE_HEARTBEAT), last_sent)
+                yield from chunks
+        finally:
+            event_broker.unsubscribe(subscription, subscription.topics)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers.update(STREAM_HEADERS)
+    return response
+
+
+def serialize_comment(comment):
+    return {'comment_id': comment.comment_id, 'post_id': comment.post_id, 'user_id': comment.user_id,
+            'text': comment.text, 'timestamp': comment.timestamp.isoformat(),
+            'author': {'user_id': comment.user.user_id, 'username': comment.user.username,
+                       'profile_pic': comment.user.profile_pic}}
+
+
+def query_post_comments(session, post_id, after=None, limit=None):
+    """Комментарии поста от старых к новым вместе с авторами (одним запросом), начиная после курсора after."""
+    query = session.query(Comment).join(Comment.user).options(contains_eager(Comment.user)).filter(
+        Comment.post_id == post_id)
+    if after:
+        timestamp, comment_id = after
+        query = query.filter(or_(Comment.timestamp > timestamp,
+                                 and_(Comment.timestamp == timestamp, Comment.comment_id > comment_id)))
+    return query.order_by(Comment.timestamp, Comment.comment_id).limit(limit)
+
+
+@api.route('/api/posts/<int:post_id>/comments', methods=['GET'])
 def get_post_comments_route(post_id):
-    """Получает комментарии к посту"""
+    """Получает комментарии к посту постранично (limit и after) или потоком (?format=ndjson)"""
+    try:
+        limit, after = parse_page_args(cursor_arg='after')
+    except ValueError:
+        return jsonify({'message': 'Invalid limit or cursor'}), 400
+
+    if wants_ndjson():
+        return stream_ndjson(lambda session: query_post_comments(session, post_id, after).yield_per(NDJSON_YIELD_PER),
+                             serialize_comment, 'комментарии')
+
     session = Session()
     try:
-        comments = session.query(Comment).filter(Comment.post_id == post_id).order_by(Comment.timestamp).all()
-        comment_list = [{'comment_id': comment.comment_id, 'post_id': comment.post_id, 'user_id': comment.user_id,
-                         'text': comment.text, 'timestamp': comment.timestamp.isoformat()} for comment in comments]
-        return jsonify(comment_list), 200
+        comments = query_post_comments(session, post_id, after, limit + 1).all()
+        comments, next_cursor = paginate(comments, limit, lambda comment: (comment.timestamp, comment.comment_id))
+        response = jsonify([serialize_comment(comment) for comment in comments])
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    except Exception as e:
+        print(f"Ошибка при получении комментариев: {e}")
+        return jsonify({'message': 'Failed to get comments'}), 500
     finally:
         session.close()
 
 
-@app.route('/api/posts/<int:post_id>/likes/count', methods=['GET'])
+@api.route('/api/posts/<int:post_id>/likes/count', methods=['GET'])
 def get_post_likes_count_route(post_id):
     """Получает количество лайков поста"""
     session = Session()
     try:
-        likes_count = session.query(Like).filter(Like.post_id == post_id).count()
-        return jsonify({'likes_count': likes_count}), 200
+        return jsonify({'likes_count': load_likes_count(session, post_id)}), 200
     except Exception as e:
         print(f"Ошибка при получении лайков поста: {e}")
         return jsonify({'message': 'Failed to get post likes'}), 500
@@ -629,123 +1482,355 @@ def get_post_likes_count_route(post_id):
         session.close()
 
 
-def allowed_file(filename):
-    return '.' in filename and \
-        filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def load_likes_count(session, post_id):
+    """Счетчик лайков поста с учетом еще не записанных лайков из буфера."""
+    likes_count, like_deltas, _ = read_with_likes(
+        lambda: session.query(Post.like_count).filter(Post.post_id == post_id).scalar() or 0,
+        lambda _: [post_id])
+    return likes_count + like_deltas.get(post_id, 0)
 
 
-def resize_and_rotate_image(img):
-    # Получаем EXIF данные для определения ориентации
+@api.route('/api/posts/<int:post_id>/comments/count', methods=['GET'])
+def get_post_comments_count_route(post_id):
+    """Получает количество комментариев поста"""
+    session = Session()
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        exif = dict(img._getexif().items())
+        comments_count = session.query(Post.comment_count).filter(Post.post_id == post_id).scalar() or 0
+        return jsonify({'comments_count': comments_count}), 200
+    except Exception as e:
+        print(f"Ошибка при получении количества комментариев: {e}")
+        return jsonify({'message': 'Failed to get post comments count'}), 500
+    finally:
+        session.close()
 
-        if exif[orientation] == 3:
-            img = img.rotate(180, expand=True)
-        elif exif[orientation] == 6:
-            img = img.rotate(270, expand=True)
-        elif exif[orientation] == 8:
-            img = img.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        # Изображение не содержит EXIF данных
-        pass
 
-    # Определяем новые размеры, сохраняя пропорции
-    MAX_SIZE = (1080, 1080)  # максимальный размер Instagram-подобного формата
-    img.thumbnail(MAX_SIZE, Image.Resampling.LANCZOS)
+def allowed_file(filename):
+    return '.' in filename and \
+        filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-    return img
 
+def image_refcounts(session, relative_paths):
+    """Число ссылок на изображения из постов и аватаров пользователей."""
+    refcounts = dict.fromkeys(relative_paths, 0)
+    for column in (Post.image_path, User.profile_pic):
+        for path, count in session.query(column, func.count()).filter(column.in_(relative_paths)).group_by(column):
+            refcounts[path] += count
+    return refcounts
+
+
+def collect_image_garbage(session, grace_hours=IMAGE_GC_GRACE_HOURS, dry_run=False, batch_size=500):
+    """Удаляет объекты хранилища без ссылок, которые старше grace_hours. Возвращает их пути."""
+    state = app_state()
+    image_store = state.image_store
+    deadline = datetime.datetime.now().timestamp() - grace_hours * 3600
+    candidates = [path for path, mtime in image_store.iter_objects() if mtime < deadline]
+    removed = []
+    for i in range(0, len(candidates), batch_size):
+        refcounts = image_refcounts(session, candidates[i:i + batch_size])
+        for path, count in refcounts.items():
+            if count == 0:
+                if not dry_run:
+                    image_store.remove(path)
+                removed.append(path)
+    if removed and not dry_run:
+        state.image_cache.clear()
+    return removed
+
+
+@api.cli.command('gc-images')
+@click.option('--grace-hours', default=IMAGE_GC_GRACE_HOURS, help='Не удалять файлы моложе этого возраста.')
+@click.option('--dry-run', is_flag=True, help='Только показать, что будет удалено.')
+def gc_images_command(grace_hours, dry_run):
+    """Удаляет изображения, на которые не ссылается ни один пост или аватар."""
+    session = Session()
+    try:
+        removed = collect_image_garbage(session, grace_hours, dry_run)
+        for path in removed:
+            print(path)
+        print(f"{'Будет удалено' if dry_run else 'Удалено'} изображений: {len(removed)}")
+    finally:
+        session.close()
 
-@app.route('/api/upload/<int:user_id>', methods=['POST'])
+
+@api.route('/api/upload/<int:user_id>', methods=['POST'])
 def upload_image(user_id):
     if 'image' not in request.files:
         return jsonify({'error': 'No image part'}), 400
 
     image = request.files['image']
+    payload, status = save_upload(image.filename, image.stream)
+    return jsonify(payload), status
 
-    if image.filename == '':
-        return jsonify({'error': 'No selected image'}), 400
-
-    if image and allowed_file(image.filename):
-        try:
-            # Генерируем уникальное имя файла
-            file_extension = os.path.splitext(image.filename)[1].lower()
-            filename = str(uuid.uuid4()) + file_extension
-
-            # Создаем путь с годом/месяцем/днем/user_id
-            now = datetime.datetime.now()
-            sub_directory = os.path.join(str(now.year), str(now.month), str(now.day), str(user_id))
-            save_directory = os.path.join(IMAGE_STORAGE_PATH, sub_directory)
-
-            # Создаем директорию, если ее нет
-            os.makedirs(save_directory, exist_ok=True)
-
-            file_path = os.path.join(save_directory, filename)
 
-            # Открываем и обрабатываем изображение
-            with Image.open(image) as img:
-                # Преобразуем в RGB если изображение в RGBA
-                if img.mode == 'RGBA':
-                    img = img.convert('RGB')
+def save_upload(filename, stream):
+    """Сохраняет загруженный файл и ставит его обработку в очередь. Возвращает (тело ответа, статус).
 
-                # Изменяем размер и поворачиваем если нужно
-                processed_img = resize_and_rotate_image(img)
+    Хэширование и проверка заголовка идут в вызывающем потоке; асинхронный сервер вызывает функцию в пуле потоков.
+    """
+    if filename == '':
+        return {'error': 'No selected image'}, 400
 
-                # Сохраняем с оптимизацией качества
-                processed_img.save(
-                    file_path,
-                    'JPEG',
-                    quality=85,
-                    optimize=True
-                )
+    if not allowed_file(filename):
+        return {'error': 'Invalid file format'}, 400
 
-            # Формируем относительный путь для сохранения в базу данных
-            relative_path = f'{sub_directory}/{filename}'.replace('\\', '/')
+    image_store = app_state().image_store
+    try:
+        # Имя файла - хэш содержимого, одинаковые загрузки попадают в один объект хранилища
+        tmp_path, digest = image_store.write_temp(stream)
+        relative_path = image_store.relative_path(digest)
+        file_path = image_store.absolute_path(relative_path)
 
-            # Для ответа клиенту формируем полный URL
-            image_url = f'{BASE_URL}/images/{relative_path}'
+        # Повторная загрузка отмечает объект, чтобы gc-images не удалил его до публикации поста
+        if image_store.touch(file_path):
+            os.remove(tmp_path)
+            return {'image_url': relative_path, 'job_id': None, 'status': 'done'}, 200
 
-            # Возвращаем относительный путь вместо полного URL
-            return jsonify({'image_url': relative_path}), 200
+        # Формат и размеры проверяем по заголовку до постановки в очередь
+        try:
+            inspect_image(tmp_path, IMAGE_MAX_PIXELS)
+        except ImageRejected as e:
+            os.remove(tmp_path)
+            return {'error': str(e)}, 400
 
-        except Exception as e:
-            return jsonify({'error': f'Error saving image: {str(e)}'}), 500
+        # Прошлая обработка этого содержимого завершилась ошибкой: пробуем снова
+        try:
+            os.remove(file_path + '.failed')
+        except FileNotFoundError:
+            pass
+
+        # Сохраняем исходный файл как есть, обработка идет в пуле процессов. Ожидающий файл без задачи
+        # в этом процессе и старше IMAGE_UPLOAD_STALE_SECONDS остался от упавшего процесса - забираем его
+        stale_after = None if image_jobs.find(relative_path) else IMAGE_UPLOAD_STALE_SECONDS
+        if not image_store.claim(tmp_path, file_path, stale_after):
+            # Такая же загрузка уже обрабатывается; если она успела завершиться, отмечаем результат
+            image_store.touch(file_path)
+            return {'image_url': relative_path, 'job_id': digest, 'status': 'pending'}, 202
+
+        # Идентификатор задачи - хэш содержимого: статус по нему восстанавливается из хранилища в любом процессе
+        job_id = image_jobs.submit(digest, file_path + '.upload', file_path, relative_path)
+        if job_id is None:
+            os.remove(file_path + '.upload')
+            return {'error': 'Too many images in processing, try again later'}, 503
+
+        # Возвращаем относительный путь сразу; файл по нему появится, когда задача завершится
+        job = image_jobs.status(job_id)
+        return {'image_url': relative_path, 'job_id': job_id, 'status': job['status']}, 202
 
-    return jsonify({'error': 'Invalid file format'}), 400
+    except Exception as e:
+        return {'error': f'Error saving image: {str(e)}'}, 500
+
+
+@api.route('/api/upload/jobs/<job_id>', methods=['GET'])
+def get_upload_job_route(job_id):
+    """Возвращает статус обработки загруженного изображения.
+
+    Статус берется из хранилища, поэтому запрос может попасть в любой рабочий процесс; процесс,
+    выполнивший задачу, добавляет к нему подробности (время обработки, размеры).
+    """
+    if not DIGEST.match(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    image_store = app_state().image_store
+    state = image_store.upload_status(job_id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job = image_jobs.status(job_id) or {}
+    if job.get('status') != state['status']:
+        job = {}
+    job.update(state, job_id=job_id, image_url=image_store.relative_path(job_id))
+    return jsonify(job), 200
+
+
+def resolve_image(image_path, size, webp):
+    """Находит файл под запрошенный размер и формат.
+
+    Возвращает (файл, mtime, ETag, байты или None), None - если файла нет.
+    """
+    image_store = app_state().image_store
+    # Формируем полный путь к файлу
+    full_path = image_store.absolute_path(image_path)
+
+    # Выбираем производный файл; у старых загрузок производных нет, для них отдаем оригинал
+    candidates = [derivative_path(full_path, size), full_path]
+    if webp:
+        candidates.insert(0, derivative_path(full_path, size, webp=True))
+    for file_path in candidates:
+        try:
+            stat = os.stat(file_path)
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        return None
+
+    # Имя файла задает содержимое (хэш исходника, размер и формат производного), поэтому ETag - из пути
+    # относительно хранилища: он одинаков во всех процессах и не зависит от mtime
+    relative_file = os.path.relpath(file_path, image_store.root).replace('\\', '/')
+    etag = hashlib.md5(relative_file.encode('utf-8')).hexdigest()
+    data = None
+    if IMAGE_MEMORY_CACHE_BYTES and stat.st_size <= IMAGE_MEMORY_CACHE_MAX_FILE:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    return file_path, stat.st_mtime, etag, data
+
+
+@api.route('/images/<path:image_path>', methods=['GET'])
+def get_image(image_path):
+    """Отдает изображение нужного размера (?size=thumb|medium|full), WebP - если клиент его принимает.
 
+    Поддерживает ETag/Last-Modified (ответ 304) и Range-запросы.
+    """
+    size = request.args.get('size', 'full')
+    if size not in IMAGE_SIZES:
+        return jsonify({'error': 'Invalid size'}), 400
+    # WebP - только если клиент назвал его явно: */* и image/* шлют и клиенты, не умеющие его декодировать
+    webp = any(mimetype == 'image/webp' and quality > 0 for mimetype, quality in request.accept_mimetypes)
 
-@app.route('/images/<path:image_path>', methods=['GET'])
-def get_image(image_path):
+    image_cache = app_state().image_cache
     try:
-        # Формируем полный путь к файлу
-        full_path = os.path.join(IMAGE_STORAGE_PATH, image_path)
-
-        # Проверяем существование файла
-        if not os.path.exists(full_path):
-            return jsonify({'error': 'Image not found'}), 404
+        cache_key = (image_path, size, webp)
+        resolved = image_cache.get(cache_key)
+        if resolved is None:
+            resolved = resolve_image(image_path, size, webp)
+            if resolved is None:
+                full_path = app_state().image_store.absolute_path(image_path)
+                if os.path.exists(full_path + '.upload'):
+                    return jsonify({'status': 'pending'}), 202
+                if os.path.exists(full_path + '.failed'):
+                    return jsonify({'status': 'failed', 'error': 'Image processing failed'}), 422
+                return jsonify({'error': 'Image not found'}), 404
+            image_cache.set(cache_key, resolved)
+        file_path, mtime, etag, data = resolved
 
         # Определяем тип файла
-        file_extension = os.path.splitext(full_path)[1].lower()
+        file_extension = os.path.splitext(file_path)[1].lower()
         mime_type = {
             '.jpg': 'image/jpeg',
             '.jpeg': 'image/jpeg',
             '.png': 'image/png',
-            '.gif': 'image/gif'
+            '.gif': 'image/gif',
+            '.webp': 'image/webp'
         }.get(file_extension, 'application/octet-stream')
 
-        # Возвращаем файл с соответствующим MIME-типом
-        return send_file(full_path, mimetype=mime_type)
+        # Возвращаем файл с соответствующим MIME-типом; conditional=True обрабатывает 304 и Range
+        response = send_file(io.BytesIO(data) if data is not None else file_path, mimetype=mime_type,
+                             etag=etag, last_modified=mtime, conditional=True, max_age=IMAGE_CACHE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept')
+        # Для 304 тела нет, для Range-запроса учитывается только отданный диапазон
+        if response.status_code != 304:
+            metrics.image_bytes.inc(response.content_length or 0, size=size, format=mime_type.split('/')[1])
+        return response
 
     except Exception as e:
         return jsonify({'error': f'Error retrieving image: {str(e)}'}), 500
 
 
-from generation import generation, hash_password
+def init_db(engine):
+    """Приводит схему к моделям и заполняет данные, которых не хватает новой схеме.
+
+    Возвращает True, если в базе доступен FTS-поиск по именам пользователей.
+    """
+    # Схема обновляется без потери данных: добавляются только недостающие таблицы, колонки и индексы
+    added_columns = migrate_schema(Base.metadata, engine)
+    username_fts = install_username_search(engine)
+    filled = backfill_folded_usernames(engine)
+    if filled:
+        print(f"Заполнены никнеймы для поиска: {filled}")
+
+    # Колонки счетчиков, добавленные к существующей базе, заполняем по фактическим данным
+    if {'posts.like_count', 'posts.comment_count'} & set(added_columns):
+        session = Session()
+        recount_post_counters(session)
+        session.commit()
+        Session.remove()
+
+    # Ленты пустые, а посты есть: FEED_FANOUT включили на существующей базе
+    if FEED_FANOUT:
+        session = Session()
+        if session.query(TimelineEntry).first() is None and session.query(Post).first() is not None:
+            print(f"Лента заполнена по существующим постам: {rebuild_timeline(session)} записей")
+            session.commit()
+        Session.remove()
+    return username_fts
+
+
+# База, с которой работают общие для процесса граф друзей и буфер лайков (задает первый create_app),
+# и время запуска последнего приложения в секундах от начала импорта
+shared_database_url = None
+startup_time = None
+
+
+def create_app(config=None):
+    """Фабрика приложения.
+
+    Настройки берутся из переменных окружения (константы выше), config - словарь, который их
+    переопределяет (DATABASE_URL, SECRET_KEY, IMAGE_STORAGE_PATH, JSON_PROVIDER, METRICS_TOKEN).
+    Создает движок базы, приводит схему к моделям и регистрирует маршруты.
+
+    Движок, хранилище изображений и кэши у каждого приложения свои (app.extensions), поэтому фабрика
+    может собрать несколько приложений, например по одному на тест. Брокер событий, пул обработки
+    изображений и метрики общие для процесса; граф друзей (FRIENDS_GRAPH_CACHE) и буфер лайков
+    (LIKE_WRITE_BEHIND) хранят данные одной базы, и приложение для другой базы с ними не создается.
+    """
+    global shared_database_url, startup_time
+    app = Flask(__name__)
+    app.config.update(DATABASE_URL=DATABASE_URL, SECRET_KEY=SECRET_KEY, IMAGE_STORAGE_PATH=IMAGE_STORAGE_PATH,
+                      JSON_PROVIDER=JSON_PROVIDER, METRICS_TOKEN=METRICS_TOKEN)
+    app.config.from_mapping(config or {})
+    if (friends_graph or like_buffer) and shared_database_url not in (None, app.config['DATABASE_URL']):
+        raise RuntimeError('FRIENDS_GRAPH_CACHE and LIKE_WRITE_BEHIND keep one database per process: '
+                           f'already bound to {shared_database_url}')
+
+    CORS(app, expose_headers=['X-Next-Cursor'])
+    register_session_teardown(app)
+    install_json_provider(app, app.config['JSON_PROVIDER'])
+    register_compression(app, min_size=COMPRESS_MIN_SIZE, level=COMPRESS_LEVEL, brotli_quality=BROTLI_QUALITY)
+
+    engine = init_engine(app.config['DATABASE_URL'])
+    app.extensions['database'] = engine
+    metrics.instrument_app(app, engine)
+    image_store = ContentStore(app.config['IMAGE_STORAGE_PATH'])
+    swept = image_store.sweep_uploads(IMAGE_UPLOAD_STALE_SECONDS)
+    if swept:
+        print(f"Удалены брошенные загрузки: {swept}")
+    app.register_blueprint(api)
+
+    state = app.extensions['glimpse'] = AppState(image_store, init_db(engine))
+    # Метрики процесса показывают кэши последнего созданного приложения
+    metrics.register_cache('auth_tokens', state.token_cache)
+    metrics.register_cache('auth_users', state.user_cache)
+    metrics.register_cache('images', state.image_cache)
+
+    shared_database_url = app.config['DATABASE_URL']
+    startup_time = time.perf_counter() - STARTUP_BEGAN
+    print(f"Приложение готово к работе за {startup_time * 1000:.0f} мс")
+    return app
+
+
+def after_fork():
+    """Вызывается в рабочем процессе сразу после fork (хук post_fork в gunicorn.conf.py).
+
+    Соединения из пула родителя забываются без закрытия: закрытие из дочернего процесса оборвало бы
+    их и у родителя. Потоков и пулов процессов родителя в дочернем процессе нет, поэтому буфер лайков
+    и очередь обработки изображений начинают с чистого состояния и создают их при первом обращении.
+    """
+    dispose_engine_after_fork()
+    image_jobs.reset_after_fork()
+    if like_buffer:
+        like_buffer.reset_after_fork()
+
 
 if __name__ == "__main__":
-    with Session(bind=engine) as session:
-        generation(session)
-        app.run(debug=True, host='0.0.0.0', port=5000)
+    app = create_app()
+    # Тестовые данные загружаются только по запросу (SEED_DATA=1) и только в пустую базу
+    if os.environ.get('SEED_DATA', '0') == '1':
+        from generation import generation
+        session = Session()
+        if session.query(User).first() is None:
+            generation(session)
+            if FEED_FANOUT:
+                rebuild_timeline(session)
+                session.commit()
+        Session.remove()
+    app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,191 @@
+"""Метрики процесса в текстовом формате Prometheus.
+
+instrument_app() вешает на приложение хуки запроса и на движок SQLAlchemy хуки выполнения
+запросов: для каждого маршрута считаются гистограмма времени ответа, число и время SQL-запросов.
+Медленные запросы (дольше SLOW_REQUEST_MS) печатаются вместе с выполненными в них SQL и
+хранятся в последних slow_log_size записях.
+
+Метрики живут в памяти процесса; при нескольких процессах каждый отдает свои.
+"""
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{name}="{_escape(value)}"' for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # метки -> [счетчики по корзинам, сумма, число наблюдений]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(key + (("le", bound),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class Metrics:
+    """Набор метрик приложения и журнал медленных запросов."""
+
+    def __init__(self, slow_request_ms=500, slow_log_size=100):
+        self.slow_request_ms = slow_request_ms
+        self.slow_requests = deque(maxlen=slow_log_size)
+        self.request_duration = Histogram('glimpse_request_duration_seconds', 'Request latency by route.')
+        self.request_queries = Histogram('glimpse_request_sql_queries', 'SQL statements executed per request.',
+                                         buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+        self.request_sql_duration = Histogram('glimpse_request_sql_duration_seconds',
+                                              'Total SQL time per request.')
+        self.image_processing = Histogram('glimpse_image_processing_seconds',
+                                          'Upload decode, resize and encode time.')
+        self.image_bytes = Counter('glimpse_image_bytes_served_total', 'Image bytes sent by get_image.')
+        self.upload_jobs = Counter('glimpse_image_jobs_total', 'Finished image processing jobs by status.')
+        # Имя кэша -> объект со stats(), значения читаются при выдаче метрик
+        self.caches = {}
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def observe_job(self, job):
+        """Вызывается по завершении задачи обработки изображения."""
+        self.upload_jobs.inc(status=job['status'])
+        if job.get('processing_time') is not None:
+            self.image_processing.observe(job['processing_time'])
+
+    def _current(self):
+        # Состояние запроса хранится в g; SQL вне запроса (CLI, фоновые потоки) не учитывается
+        if has_request_context():
+            return g.get('_metrics')
+        return None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['_metrics_started'].pop()
+        state = self._current()
+        if state is not None:
+            elapsed = time.perf_counter() - started
+            state['queries'].append((statement, elapsed))
+            state['sql_time'] += elapsed
+
+    def _handle_error(self, exception_context):
+        # Для упавшего запроса after_cursor_execute не вызывается, снимаем его отметку времени
+        started = exception_context.connection.info.get('_metrics_started') \
+            if exception_context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _before_request(self):
+        g._metrics = {'started': time.perf_counter(), 'queries': [], 'sql_time': 0.0}
+
+    def _after_request(self, response):
+        state = g.pop('_metrics', None)
+        if state is None:
+            return response
+        elapsed = time.perf_counter() - state['started']
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.request_duration.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        self.request_queries.observe(len(state['queries']), route=route)
+        self.request_sql_duration.observe(state['sql_time'], route=route)
+
+        if elapsed * 1000 >= self.slow_request_ms:
+            entry = {
+                'method': request.method,
+                # Без строки запроса: в ней бывают чужие данные (например, поисковые запросы)
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 1),
+                'sql_time_ms': round(state['sql_time'] * 1000, 1),
+                'queries': [{'sql': ' '.join(statement.split()), 'duration_ms': round(duration * 1000, 2)}
+                            for statement, duration in state['queries']],
+            }
+            self.slow_requests.append(entry)
+            print(f"Медленный запрос {entry['method']} {entry['path']}: {entry['duration_ms']} мс, "
+                  f"SQL: {len(entry['queries'])} запросов, {entry['sql_time_ms']} мс")
+            for query in sorted(entry['queries'], key=lambda q: q['duration_ms'], reverse=True)[:5]:
+                print(f"  {query['duration_ms']} мс: {query['sql'][:500]}")
+        return response
+
+    def instrument_app(self, app, engine):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        for metric in (self.request_duration, self.request_queries, self.request_sql_duration,
+                       self.image_processing, self.image_bytes, self.upload_jobs):
+            lines.extend(metric.render())
+
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        for field, metric_type, documentation in (('hits', 'counter', 'Cache hits.'),
+                                                  ('misses', 'counter', 'Cache misses.'),
+                                                  ('hit_rate', 'gauge', 'Cache hit rate since start.'),
+                                                  ('items', 'gauge', 'Entries in cache.'),
+                                                  ('bytes', 'gauge', 'Bytes held by cache.')):
+            name = f'glimpse_cache_{field}' + ('_total' if metric_type == 'counter' else '')
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for cache_name, cache_stats in sorted(stats.items()):
+                lines.append(f'{name}{_format_labels((("cache", cache_name),))} {cache_stats[field]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,137 @@
+"""Модели базы данных (SQLAlchemy).
+
+Модуль не зависит от приложения: модели импортируют main.py, генераторы тестовых данных и скрипты.
+"""
+import datetime
+
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, UniqueConstraint, Index
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+def fold_username(context):
+    """Значение username_folded по умолчанию: никнейм, приведенный casefold()."""
+    username = context.get_current_parameters().get('username')
+    return username.casefold() if username is not None else None
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    user_id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String(50), unique=True, nullable=False)
+    password = Column(String(255), nullable=False)  # Храним хэш пароля
+    email = Column(String(100), unique=True, nullable=False)
+    profile_pic = Column(String(255), nullable=True)  # Путь к файлу изображения
+    status = Column(String(100), default="")
+    # Никнейм в casefold() для поиска: точные и префиксные совпадения ищутся по индексу
+    username_folded = Column(String(50), nullable=True, default=fold_username)
+
+    # Индекс для подсчета ссылок на изображения при сборке мусора
+    __table_args__ = (
+        Index('ix_users_profile_pic', 'profile_pic'),
+        Index('ix_users_username_folded', 'username_folded', 'user_id'),
+    )
+
+    posts = relationship("Post", back_populates="user")
+    comments = relationship("Comment", back_populates="user")
+    likes = relationship("Like", back_populates="user")
+
+    @validates('username')
+    def sync_username_folded(self, key, username):
+        """Держит username_folded в соответствии с никнеймом при изменении через ORM."""
+        self.username_folded = username.casefold() if username is not None else None
+        return username
+
+    def __repr__(self):
+        return f"<User(username='{self.username}', email='{self.email}')>"
+
+
+class Post(Base):
+    __tablename__ = "posts"
+
+    post_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    image_path = Column(String(255), nullable=False)
+    caption = Column(Text, nullable=True)
+    # Функция, а не ее результат: время вычисляется для каждой строки, а не один раз при импорте
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    # Денормализованные счетчики, обновляются в одной транзакции с лайками и комментариями
+    like_count = Column(Integer, nullable=False, default=0, server_default='0')
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # Покрывающий индекс для ленты: посты автора в порядке времени
+    __table_args__ = (
+        Index('ix_posts_user_id_timestamp', 'user_id', 'timestamp'),
+        Index('ix_posts_image_path', 'image_path'),
+    )
+
+    user = relationship("User", back_populates="posts")
+    comments = relationship("Comment", back_populates="post")
+    likes = relationship("Like", back_populates="post")
+
+    def __repr__(self):
+        return f"<Post(post_id={self.post_id}, caption='{self.caption}')>"
+
+
+class Friendship(Base):
+    __tablename__ = "friendships"
+
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+    friend_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+
+    # Составной первичный ключ (user_id, friend_id) уже служит индексом для выборки друзей пользователя
+    __table_args__ = (
+        UniqueConstraint('user_id', 'friend_id', name='unique_friendship'),
+    )
+
+    user = relationship("User", foreign_keys=[user_id])
+    friend = relationship("User", foreign_keys=[friend_id])
+
+
+class Comment(Base):
+    __tablename__ = "comments"
+
+    comment_id = Column(Integer, primary_key=True, autoincrement=True)
+    post_id = Column(Integer, ForeignKey("posts.post_id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    text = Column(Text, nullable=False)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+
+    # Комментарии поста читаются страницами по (timestamp, comment_id)
+    __table_args__ = (
+        Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp', 'comment_id'),
+    )
+
+    post = relationship("Post", back_populates="comments")
+    user = relationship("User", back_populates="comments")
+
+    def __repr__(self):
+        return f"<Comment(comment_id={self.comment_id}, text='{self.text}')>"
+
+
+class Like(Base):
+    __tablename__ = "likes"
+
+    post_id = Column(Integer, ForeignKey("posts.post_id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+
+    post = relationship("Post", back_populates="likes")
+    user = relationship("User", back_populates="likes")
+
+
+class TimelineEntry(Base):
+    """Пост в ленте пользователя user_id (при FEED_FANOUT=1). Время поста продублировано для сортировки по индексу."""
+    __tablename__ = "timeline"
+
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+    post_id = Column(Integer, ForeignKey("posts.post_id"), primary_key=True)
+    author_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+    # Лента читается диапазоном по этому индексу от новых к старым
+    __table_args__ = (
+        Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),
+    )
@@ -0,0 +1,108 @@
+"""Сериализация и сжатие ответов.
+
+Если установлен orjson, JSON ответов собирается им (в разы быстрее стандартного json).
+Ответы JSON и NDJSON больше min_size сжимаются brotli (если установлен пакет brotli и клиент
+его принимает) или gzip. Потоковые ответы сжимаются по частям, не собираясь в памяти целиком.
+Оба пакета необязательны: без них используются json и gzip из стандартной библиотеки.
+"""
+import gzip
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на orjson. Ключи сортируются, как у стандартного провайдера."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def install_json_provider(app, name='orjson'):
+    """Включает быстрый JSON-провайдер, если он доступен. Возвращает имя используемого провайдера."""
+    if name == 'orjson' and orjson is not None:
+        app.json_provider_class = OrjsonProvider
+        app.json = OrjsonProvider(app)
+        return 'orjson'
+    return 'json'
+
+
+def choose_encoding(accept_encodings):
+    """Кодировка сжатия по Accept-Encoding (объект Accept из werkzeug): br, gzip или None."""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_body(body, encoding, level=6, brotli_quality=4):
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=level)
+
+
+def make_compressor(encoding, level=6, brotli_quality=4):
+    """Потоковый компрессор: (compress(часть), finish()). После каждой части буфер сбрасывается,
+    чтобы клиент получал данные сразу."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        return lambda chunk: compressor.process(chunk) + compressor.flush(), compressor.finish
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _compress_stream(chunks, encoding, level, brotli_quality):
+    compress, finish = make_compressor(encoding, level, brotli_quality)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def register_compression(app, min_size=1024, level=6, brotli_quality=4):
+    """Сжимает ответы JSON/NDJSON по Accept-Encoding. Обычные ответы - если тело не меньше min_size байт."""
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers \
+                or response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, level, brotli_quality)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < min_size:
+                return response
+            response.set_data(compress_body(body, encoding, level, brotli_quality))
+        response.headers['Content-Encoding'] = encoding
+        return response
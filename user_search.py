@@ -0,0 +1,136 @@
+"""Поиск пользователей по никнейму.
+
+Результаты ранжируются: точное совпадение, затем префикс, затем подстрока. Каждый ранг выбирается
+своим запросом со своим LIMIT, поэтому страница не требует ранжировать все совпадения:
+- точные и префиксные совпадения ищутся по индексу на users.username_folded (никнейм в casefold());
+- подстроки в SQLite ищутся в виртуальной таблице FTS5 с токенизатором trigram (users_fts), которую
+  синхронизируют с users триггеры; на других СУБД (или без FTS5) - LIKE по users.
+
+Двухсимвольные запросы триграммный индекс не покрывает: подстроки для них ищутся LIKE по
+users.username_folded с просмотром в порядке user_id до LIMIT совпадений. Частые пары букв
+находятся быстро, редкие могут просмотреть всю таблицу.
+"""
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+FTS_TABLE_DDL = ("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts "
+                 "USING fts5(username, content='users', content_rowid='user_id', tokenize='trigram')")
+FTS_TRIGGERS_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username) VALUES (new.user_id, new.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.user_id, old.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username) VALUES ('delete', old.user_id, old.username); "
+    "INSERT INTO users_fts(rowid, username) VALUES (new.user_id, new.username); END",
+)
+
+COLUMNS = 'u.user_id, u.username, u.email, u.profile_pic, u.status'
+
+# sort_key - порядок внутри ранга: префиксные совпадения идут по username_folded (как в индексе)
+EXACT_SQL = f"""
+SELECT {COLUMNS}, 0 AS rank, '' AS sort_key FROM users u
+WHERE u.username_folded = :folded AND u.user_id != :exclude_user_id {{after}}
+ORDER BY u.user_id {{limit}}
+"""
+PREFIX_SQL = f"""
+SELECT {COLUMNS}, 1 AS rank, u.username_folded AS sort_key FROM users u
+WHERE u.username_folded > :folded AND u.username_folded < :prefix_end AND u.user_id != :exclude_user_id {{after}}
+ORDER BY u.username_folded, u.user_id {{limit}}
+"""
+SUBSTRING_SQL = f"""
+SELECT {COLUMNS}, 2 AS rank, '' AS sort_key FROM {{source}}
+WHERE {{condition}} AND substr(u.username_folded, 1, :length) != :folded AND u.user_id != :exclude_user_id {{after}}
+ORDER BY {{key}} {{limit}}
+"""
+# Верхняя граница диапазона префикса: символ больше любого другого
+PREFIX_END = '\U0010ffff'
+
+
+def install_username_search(engine):
+    """Создает users_fts и триггеры синхронизации. Возвращает True, если FTS5-поиск доступен."""
+    if engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with engine.begin() as connection:
+            triggers_exist = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'users_fts_insert'")).first()
+            connection.execute(text(FTS_TABLE_DDL))
+            for ddl in FTS_TRIGGERS_DDL:
+                connection.execute(text(ddl))
+            # Триггеры удаляются вместе с таблицей users; если их не было, индекс мог устареть
+            if not triggers_exist:
+                connection.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+    except OperationalError as e:
+        print(f"Поиск FTS5 недоступен, используется LIKE: {e}")
+        return False
+    return True
+
+
+def backfill_folded_usernames(engine, batch_size=10000):
+    """Заполняет users.username_folded там, где он пуст (база до появления колонки). Возвращает число строк."""
+    filled = 0
+    with engine.connect() as connection:
+        while True:
+            rows = connection.execute(text(
+                "SELECT user_id, username FROM users WHERE username_folded IS NULL LIMIT :limit"),
+                {'limit': batch_size}).all()
+            if not rows:
+                break
+            connection.execute(text("UPDATE users SET username_folded = :folded WHERE user_id = :user_id"),
+                               [{'folded': username.casefold(), 'user_id': user_id} for user_id, username in rows])
+            connection.commit()
+            filled += len(rows)
+    return filled
+
+
+def search_users(session, query, exclude_user_id, limit, after=None, fts=True, yield_per=None):
+    """Ищет пользователей по никнейму: точное совпадение, префикс, подстрока.
+
+    after - курсор (rank, user_id) последней строки предыдущей страницы; limit=None - без ограничения.
+    Возвращает строки с полями user_id, username, email, profile_pic, status, rank; с yield_per -
+    итератор, читающий результат из базы частями по yield_per строк.
+    """
+    folded = query.casefold()
+    after_rank, after_user_id = after if after else (-1, 0)
+    params = {'folded': folded, 'length': len(folded), 'prefix_end': folded + PREFIX_END,
+              'exclude_user_id': exclude_user_id, 'limit': limit, 'after_user_id': after_user_id}
+    limit_sql = 'LIMIT :limit' if limit is not None else ''
+
+    tiers = []
+    if after_rank <= 0:
+        tiers.append(EXACT_SQL.format(after='AND u.user_id > :after_user_id' if after_rank == 0 else '',
+                                      limit=limit_sql))
+    if after_rank <= 1:
+        after_sql = ''
+        if after_rank == 1:
+            # Внутри ранга префикса порядок (username_folded, user_id); никнейм берем по user_id курсора
+            params['after_folded'] = session.execute(
+                text("SELECT username_folded FROM users WHERE user_id = :after_user_id"),
+                params).scalar() or folded
+            after_sql = 'AND (u.username_folded, u.user_id) > (:after_folded, :after_user_id)'
+        tiers.append(PREFIX_SQL.format(after=after_sql, limit=limit_sql))
+    if after_rank <= 2:
+        if fts and len(folded) >= 3:
+            source = 'users_fts JOIN users u ON u.user_id = users_fts.rowid'
+            condition = 'users_fts MATCH :match'
+            key = 'users_fts.rowid'  # FTS5 отдает совпадения по возрастанию rowid, без сортировки
+            params['match'] = '"' + query.replace('"', '""') + '"'
+        else:
+            # Без FTS и для двух символов - LIKE с просмотром по user_id до LIMIT совпадений
+            escaped = folded.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            source = 'users u'
+            key = 'u.user_id'
+            condition = "u.username_folded LIKE :pattern ESCAPE '\\'"
+            params['pattern'] = f'%{escaped}%'
+        tiers.append(SUBSTRING_SQL.format(source=source, condition=condition, key=key,
+                                          after=f'AND {key} > :after_user_id' if after_rank == 2 else '',
+                                          limit=limit_sql))
+    if not tiers:
+        return []
+
+    sql = ' UNION ALL '.join(f'SELECT * FROM ({tier}) AS tier{index}' for index, tier in enumerate(tiers))
+    sql += f' ORDER BY rank, sort_key, user_id {limit_sql}'
+    if yield_per:
+        return session.execute(text(sql).execution_options(yield_per=yield_per), params).mappings()
+    return session.execute(text(sql), params).mappings().all()